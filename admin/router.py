@@ -0,0 +1,25 @@
+from fastapi import APIRouter, Query
+from fastapi.responses import StreamingResponse
+
+from auth.utils import ensure_authority
+from .utils import User, ExportName, export
+
+
+router = APIRouter()
+
+
+@router.get(
+    "/export/{name}/",
+    response_class=StreamingResponse,
+    response_description="Operation successful.",
+    description="Streams every document of the given collection as NDJSON, optionally gzipped.",
+    summary="Export Collection"
+)
+@ensure_authority(mode="admin")
+async def export_collection(user: User, name: ExportName, compress: bool = Query(False, description="Gzip the export")):
+    filename = f"{name}.ndjson" + (".gz" if compress else "")
+    return StreamingResponse(
+        export(name, compress),
+        media_type="application/gzip" if compress else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
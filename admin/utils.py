@@ -0,0 +1,53 @@
+from typing import Annotated, AsyncIterator, Literal
+from pathlib import Path
+import zlib
+
+from fastapi import Depends
+from bson import json_util
+
+from core.mongodb import Manager
+from core.settings import (
+    MONGODB_COLLECTION_USERS,
+    MONGODB_COLLECTION_ROOMS,
+    MONGODB_COLLECTION_MESSAGES,
+    MONGODB_MESSAGES_BUCKET_SIZE,
+    MONGODB_EXPORT_BATCH_SIZE
+)
+from auth.dependencies import get_user
+
+
+User = Annotated[dict, Depends(get_user)]
+ExportName = Literal["users", "rooms", "messages"]
+# name -> (collection, projection, batch size). A message document is a bucket of up to MONGODB_MESSAGES_BUCKET_SIZE
+# messages, so its batches hold as many messages as the other batches hold documents.
+exports = {
+    "users": (MONGODB_COLLECTION_USERS, {"password": 0}, MONGODB_EXPORT_BATCH_SIZE),
+    "rooms": (MONGODB_COLLECTION_ROOMS, None, MONGODB_EXPORT_BATCH_SIZE),
+    "messages": (MONGODB_COLLECTION_MESSAGES, None, max(MONGODB_EXPORT_BATCH_SIZE // MONGODB_MESSAGES_BUCKET_SIZE, 1)),
+}
+
+
+async def export(name: ExportName, compress: bool = False) -> AsyncIterator[bytes]:
+    """
+    Streams the collection as NDJSON (Extended JSON, one document per line), optionally gzipped,
+    with memory bounded by the batch size of the export no matter how large the collection is.
+    """
+
+    collection, projection, batch_size = exports[name]
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16) if compress else None
+    async for document in Manager.stream(collection, projection=projection, batch_size=batch_size):
+        line = (json_util.dumps(document) + "\n").encode()
+        if compressor is None:
+            yield line
+        elif chunk := compressor.compress(line):
+            yield chunk
+    if compressor is not None:
+        yield compressor.flush()
+
+
+async def export_to_file(name: ExportName, path: Path, compress: bool = False) -> int:
+    written = 0
+    with open(path, "wb") as file:
+        async for chunk in export(name, compress):
+            written += file.write(chunk)
+    return written
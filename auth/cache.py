@@ -0,0 +1,37 @@
+import json
+
+import bson
+
+from core import redis
+from core.settings import REDIS_USER_CACHE_PREFIX, REDIS_USER_CACHE_TTL, REDIS_USER_CACHE_FIELDS
+
+
+def key(username: str) -> str:
+    return f"{REDIS_USER_CACHE_PREFIX}:{username}"
+
+
+async def get_cached_user(username: str) -> dict | None:
+    if (user := await redis.Manager.get_db().get(key(username))) is None:
+        return None
+    user = json.loads(user)
+    user["_id"] = bson.ObjectId(user["_id"])
+    return user
+
+
+async def cache_user(user: dict) -> dict:
+    """
+    Stores only the fields the handlers need and returns them, so cache hits and misses look the same to the caller.
+    """
+
+    user = {field: user[field] for field in REDIS_USER_CACHE_FIELDS if field in user}
+    await redis.Manager.get_db().set(
+        key(user["username"]),
+        json.dumps({**user, "_id": str(user["_id"])}),
+        ex=REDIS_USER_CACHE_TTL
+    )
+    return user
+
+
+async def invalidate_user(*usernames: str) -> None:
+    if usernames:
+        await redis.Manager.get_db().delete(*(key(username) for username in usernames))
@@ -1,12 +1,19 @@
 from core.mongodb import Manager
 from core.exceptions import AuthenticationFailedError
 
+from .cache import get_cached_user, cache_user
 from .utils import collection, OAuth2Scheme, verified_access_token
 
 
 async def get_user(token: OAuth2Scheme) -> dict:
-    return await Manager.get_or_fail(
-        collection,
-        verified_access_token(token),
-        AuthenticationFailedError
+    payload = verified_access_token(token)
+    if (user := await get_cached_user(payload["username"])) is not None and user["email"] == payload["email"]:
+        return user
+
+    return await cache_user(
+        await Manager.get_or_fail(
+            collection,
+            payload,
+            AuthenticationFailedError
+        )
     )
@@ -10,7 +10,7 @@ import jwt
 from core.settings import MONGODB_COLLECTION_USERS, LOGIN_URL, JWT_SECRET_KEY, JWT_ALGORITHM, JWT_ACCESS_TOKEN_EXPIRY
 from core.mongodb import Manager
 from core.exceptions import AuthenticationFailedError, ActionForbiddenError
-from core.hash import is_valid_password
+from core.hash import is_valid_password_async
 from .schemas import TokenPayload
 
 
@@ -21,7 +21,7 @@ RequestForm = Annotated[OAuth2PasswordRequestForm, Depends()]
 
 async def authenticate(user_1: RequestForm) -> dict:
     user_2 = await Manager.get_or_fail(collection, {"username": user_1.username}, AuthenticationFailedError)
-    if not is_valid_password(user_1.password, user_2["password"]):
+    if not await is_valid_password_async(user_1.password, user_2["password"]):
         raise AuthenticationFailedError
     else:
         return user_2
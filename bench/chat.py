@@ -0,0 +1,129 @@
+"""
+Drives simulated Socket.IO clients through connect -> private_room -> private_message
+and reports connects/s, messages/s and the delivery latency percentiles.
+"""
+
+from typing import Callable
+import asyncio
+import time
+
+import socketio
+
+from auth.utils import create_access_token
+from .utils import Server, percentiles
+
+
+class Pair:
+    def __init__(self, i: int, url: str, latencies: list, expected: int, done: asyncio.Event):
+        self.i = i
+        self.url = url
+        self.sender = socketio.AsyncClient(reconnection=False)
+        self.receiver = socketio.AsyncClient(reconnection=False)
+        self.sent = {}
+        self.received = 0
+        self.errors = 0
+        self.expected = expected
+        self.latencies = latencies
+        self.done = done
+        self.room = None
+
+        @self.receiver.on("private_message")
+        async def on_message(data):
+            if (sent := self.sent.pop(data, None)) is not None:
+                self.latencies.append(time.perf_counter() - sent)
+                self.received += 1
+                self.check()
+
+        @self.sender.on("error")
+        async def on_error(_):
+            # Refused messages, e.g. rate limited ones, are never delivered, so stop waiting for them.
+            self.errors += 1
+            self.check()
+
+    def check(self):
+        if self.received + self.errors >= self.expected:
+            self.done.set()
+
+    @staticmethod
+    def token(username: str) -> str:
+        return create_access_token({"username": username, "email": f"{username}@example.com"})
+
+    async def connect(self):
+        for client, username in ((self.sender, f"bench_s_{self.i}"), (self.receiver, f"bench_r_{self.i}")):
+            await client.connect(
+                self.url,
+                headers={"Authorization": f"Bearer {self.token(username)}"},
+                transports=["websocket"]
+            )
+
+    async def join(self):
+        self.room = await self.sender.call("private_room", {"receiver": f"bench_r_{self.i}"})
+
+    async def send(self, messages: int):
+        for n in range(messages):
+            message = f"{self.i}:{n}"
+            self.sent[message] = time.perf_counter()
+            await self.sender.emit("private_message", {"room": self.room, "message": message})
+
+    async def close(self):
+        await asyncio.gather(self.sender.disconnect(), self.receiver.disconnect())
+
+
+async def bench(url: str, pairs: int, messages: int, timeout: float) -> dict:
+    latencies = []
+    events = [asyncio.Event() for _ in range(pairs)]
+    clients = [Pair(i, url, latencies, messages, events[i]) for i in range(pairs)]
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client.connect() for client in clients))
+    connect_time = time.perf_counter() - started
+    await asyncio.gather(*(client.join() for client in clients))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client.send(messages) for client in clients))
+    try:
+        await asyncio.wait_for(asyncio.gather(*(event.wait() for event in events)), timeout)
+    except asyncio.TimeoutError:
+        pass
+    send_time = time.perf_counter() - started
+    await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+
+    return {
+        "clients": pairs * 2,
+        "messages_sent": pairs * messages,
+        "messages_delivered": len(latencies),
+        "errors": sum(client.errors for client in clients),
+        "connects_per_second": pairs * 2 / connect_time,
+        "messages_per_second": len(latencies) / send_time,
+        "latency_seconds": percentiles(latencies, 0.5, 0.99, 0.999)
+    }
+
+
+async def run(
+    app_factory: Callable,
+    clients: int,
+    messages: int,
+    url: str = None,
+    standins: bool = True,
+    rate_limit: bool = False,
+    timeout: float = 60
+) -> dict:
+    """
+    Benchmarks the server at `url`, or an in-process server built by `app_factory` when no url is given.
+    Clients are paired, one sender and one receiver per private room. The synthetic users send far faster
+    than the per-user rate limits allow, so the limiter of the in-process server is off unless `rate_limit`.
+    A remote server is benchmarked with its own limits, set SOCKETIO_RATE_LIMIT=false there to lift them.
+    """
+
+    pairs = max(clients // 2, 1)
+    if url is not None:
+        return await bench(url, pairs, messages, timeout)
+
+    if standins:
+        from .standins import install
+        install()
+    if not rate_limit:
+        from chat import limits
+        limits.enabled = False
+    async with Server(app_factory) as server:
+        return await bench(server.url, pairs, messages, timeout)
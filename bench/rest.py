@@ -0,0 +1,167 @@
+"""
+Benchmarks the REST API in-process, through httpx's ASGI transport and the MongoDB/Redis stand-ins,
+and breaks the cost of a request down into validation, authentication, database and serialization.
+"""
+
+from typing import Callable
+from pathlib import Path
+import asyncio
+import json
+import time
+
+import httpx
+
+from core.mongodb import Manager
+from core.hash import hash_password
+from core.settings import API_PREFIX, MONGODB_COLLECTION_USERS
+from auth.utils import create_access_token, verified_access_token
+from auth.dependencies import get_user
+from user.schemas import UserCreate, UserResponse, UsersResponse
+from .utils import percentiles
+
+
+BASELINE = Path(__file__).resolve().parent / "baseline.json"
+PASSWORD = "bench-password"
+
+
+async def measure(func: Callable, iterations: int) -> dict:
+    latencies = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        call_started = time.perf_counter()
+        await func(i)
+        latencies.append(time.perf_counter() - call_started)
+    return {
+        "requests_per_second": iterations / (time.perf_counter() - started),
+        "latency_seconds": percentiles(latencies, 0.5, 0.99)
+    }
+
+
+async def mean(func: Callable, iterations: int) -> float:
+    started = time.perf_counter()
+    for i in range(iterations):
+        await func(i)
+    return (time.perf_counter() - started) / iterations
+
+
+async def seed(users: int) -> dict:
+    password = hash_password(PASSWORD)
+    admin = {"username": "bench_admin", "email": "bench_admin@example.com", "password": password, "is_admin": True}
+    await Manager.get_db()[MONGODB_COLLECTION_USERS].insert_one(admin)
+    await Manager.get_db()[MONGODB_COLLECTION_USERS].insert_many([
+        {"username": f"bench_user_{i}", "email": f"bench_user_{i}@example.com", "password": password}
+        for i in range(users)
+    ])
+    return admin
+
+
+async def endpoints(client: httpx.AsyncClient, admin: dict, iterations: int) -> dict:
+    headers = {"Authorization": f"Bearer {create_access_token({'username': admin['username'], 'email': admin['email']})}"}
+    users, created = f"/{API_PREFIX}/user", []
+
+    async def login(_):
+        res = await client.post(f"/{API_PREFIX}/auth/", data={"username": admin["username"], "password": PASSWORD})
+        res.raise_for_status()
+
+    async def read_users(_):
+        (await client.get(f"{users}/", params={"limit": 100}, headers=headers)).raise_for_status()
+
+    async def read_user(_):
+        (await client.get(f"{users}/{admin['_id']}/", headers=headers)).raise_for_status()
+
+    async def create_user(i):
+        res = await client.post(
+            f"{users}/",
+            json={"username": f"bench_new_{i}", "email": f"bench_new_{i}@example.com", "password": PASSWORD}
+        )
+        res.raise_for_status()
+        created.append(res.json())
+
+    async def update_user(i):
+        email = f"bench_admin_{i}@example.com"
+        (await client.put(f"{users}/{admin['_id']}/", json={"email": email}, headers=headers)).raise_for_status()
+        # The token carries the email, so changing it back takes a token for the new one.
+        renamed = {"Authorization": f"Bearer {create_access_token({'username': admin['username'], 'email': email})}"}
+        (await client.put(f"{users}/{admin['_id']}/", json={"email": admin["email"]}, headers=renamed)).raise_for_status()
+
+    # bcrypt dominates login and user creation, so they run fewer iterations.
+    slow = max(iterations // 10, 1)
+    return {
+        "login": await measure(login, slow),
+        "read_users": await measure(read_users, iterations),
+        "read_user": await measure(read_user, iterations),
+        "create_user": await measure(create_user, slow),
+        "update_user": await measure(update_user, iterations // 2 or 1)
+    }
+
+
+async def breakdown(admin: dict, iterations: int) -> dict:
+    """
+    Mean cost in seconds of each stage of an authenticated read, measured in isolation.
+    """
+
+    token = create_access_token({"username": admin["username"], "email": admin["email"]})
+    documents = await Manager.get_db()[MONGODB_COLLECTION_USERS].find().limit(100).to_list(length=100)
+
+    async def validation(i):
+        UserCreate(username=f"bench_v_{i}", email=f"bench_v_{i}@example.com", password=PASSWORD)
+
+    async def auth(_):
+        await get_user(token)
+
+    async def token_decode(_):
+        verified_access_token(token)
+
+    async def database(_):
+        await Manager.get_or_fail(MONGODB_COLLECTION_USERS, {"_id": admin["_id"]})
+
+    async def serialization(_):
+        UsersResponse(users=[UserResponse.model_validate(document) for document in documents]).model_dump_json()
+
+    return {
+        "validation": await mean(validation, iterations),
+        "auth": await mean(auth, iterations),
+        "auth_token_decode": await mean(token_decode, iterations),
+        "database": await mean(database, iterations),
+        "serialization_100_users": await mean(serialization, iterations)
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Returns the metrics which regressed by more than `tolerance` (a fraction) against the baseline.
+    """
+
+    regressions = []
+    for name, current in report["endpoints"].items():
+        if (previous := baseline.get("endpoints", {}).get(name)) is not None:
+            if current["requests_per_second"] < previous["requests_per_second"] * (1 - tolerance):
+                regressions.append(f"endpoints.{name}.requests_per_second")
+    for name, current in report["breakdown"].items():
+        if (previous := baseline.get("breakdown", {}).get(name)) is not None:
+            if current > previous * (1 + tolerance):
+                regressions.append(f"breakdown.{name}")
+    return regressions
+
+
+async def run(app_factory: Callable, iterations: int, users: int) -> dict:
+    from .standins import install
+    install()
+
+    app = app_factory()
+    async with app.router.lifespan_context(app):
+        admin = await seed(users)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+            return {
+                "endpoints": await endpoints(client, admin, iterations),
+                "breakdown": await breakdown(admin, iterations)
+            }
+
+
+def run_and_compare(app_factory: Callable, iterations: int, users: int, baseline: Path, update: bool, tolerance: float) -> dict:
+    report = asyncio.run(run(app_factory, iterations, users))
+    if baseline.exists():
+        report["regressions"] = compare(report, json.loads(baseline.read_text()), tolerance)
+    if update or not baseline.exists():
+        baseline.write_text(json.dumps({k: v for k, v in report.items() if k != "regressions"}, indent=4))
+    return report
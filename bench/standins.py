@@ -0,0 +1,24 @@
+"""
+In-process stand-ins for MongoDB and Redis, so the benchmarks run without any external service.
+They measure the application code rather than the databases, so compare their numbers only with each other.
+"""
+
+from mongomock_motor import AsyncMongoMockClient
+from fakeredis import aioredis
+
+from core import mongodb, redis
+
+
+class FakeRedis:
+    @staticmethod
+    def from_url(*_, **kwargs):
+        return aioredis.FakeRedis(**kwargs)
+
+
+def install() -> None:
+    """
+    Makes `mongodb.Manager` and `redis.Manager` connect to the stand-ins instead of MONGODB_URL and REDIS_URL.
+    """
+
+    mongodb.AsyncIOMotorClient = lambda *_, **__: AsyncMongoMockClient()
+    redis.InstrumentedRedis = FakeRedis
@@ -0,0 +1,52 @@
+from typing import Callable
+import asyncio
+import socket
+
+import uvicorn
+
+
+def percentiles(samples: list, *quantiles: float) -> dict:
+    """
+    Returns the nearest-rank percentiles of the samples, named like p50, p99 and p999.
+    """
+
+    samples = sorted(samples)
+    return {
+        "p" + f"{q * 100:g}".replace(".", ""): samples[min(int(q * len(samples)), len(samples) - 1)] if samples else None
+        for q in quantiles
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Server:
+    """
+    Runs the app on a local port inside the current event loop, lifespan included.
+    """
+
+    def __init__(self, app_factory: Callable):
+        self.port = free_port()
+        self.server = uvicorn.Server(
+            uvicorn.Config(app_factory(), host="127.0.0.1", port=self.port, lifespan="on", log_level="warning")
+        )
+        self.task = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    async def __aenter__(self):
+        self.task = asyncio.create_task(self.server.serve())
+        while not self.server.started:
+            if self.task.done():
+                await self.task
+            await asyncio.sleep(0.05)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.server.should_exit = True
+        await self.task
@@ -1,112 +1,238 @@
-import json
+from contextlib import asynccontextmanager, suppress
+from datetime import datetime
+from functools import wraps
+import asyncio
+import re
 
 from socketio.exceptions import ConnectionRefusedError
 import socketio
 import bson
 
 from core import mongodb, redis
+from core.mongodb import (
+    add_message_to_room,
+    add_message_to_inbox,
+    add_room_to_inbox,
+    get_room_messages,
+    get_inbox,
+    encode_cursor,
+    decode_cursor,
+    new_message
+)
 from core.exceptions import EntityDoesNotExistError, EntityAlreadyExistsError
-from core.settings import SOCKETIO_PING_INTERVAL, SOCKETIO_PING_TIMEOUT, SOCKETIO_DEBUG, SOCKETIO_CORS_ALLOWED_ORIGINS
+from core.logging import log
+from core.metrics import timed, Gauge, SOCKETIO_EVENT_DURATION, SOCKETIO_CONNECTED_SOCKETS
+from core.settings import (
+    SOCKETIO_PING_INTERVAL,
+    SOCKETIO_PING_TIMEOUT,
+    SOCKETIO_DEBUG,
+    SOCKETIO_CORS_ALLOWED_ORIGINS,
+    SOCKETIO_ROOM_HISTORY_PAGE_SIZE,
+    SOCKETIO_PREVIOUS_ROOMS_PAGE_SIZE,
+    SOCKETIO_REDIS_MANAGER,
+    SOCKETIO_TRANSPORTS,
+    SOCKETIO_REDIS_CHANNEL,
+    SOCKETIO_SHUTDOWN_TIMEOUT,
+    SOCKETIO_EPHEMERAL_TYPES,
+    SOCKETIO_RATE_LIMITS,
+    MONGODB_COLLECTION_USERS,
+    MONGODB_COLLECTION_ROOMS,
+    MONGODB_COLLECTION_INBOX,
+    MONGODB_WRITE_BEHIND
+)
 from auth.utils import verified_access_token
+from auth.cache import get_cached_user, cache_user
+from .writer import MessageWriter
+from . import presence, rooms, search, delivery, limits
+from .ephemeral import Coalescer
+from .utils import serialize_message, serialize_timestamp
 from .exceptions import (
     authentication_failed_error,
     entity_does_not_exist_error,
     entity_already_exists_error,
     receiver_required_error,
-    sender_is_receiver_error
+    sender_is_receiver_error,
+    not_a_member_error,
+    rate_limited_error,
+    overloaded_error
 )
 
 
 sio = socketio.AsyncServer(
     async_mode='asgi',
+    client_manager=redis.Manager.get_client_manager(SOCKETIO_REDIS_CHANNEL) if SOCKETIO_REDIS_MANAGER else None,
     ping_interval=SOCKETIO_PING_INTERVAL,
     ping_timeout=SOCKETIO_PING_TIMEOUT,
     logger=SOCKETIO_DEBUG,
     engineio_logger=SOCKETIO_DEBUG,
-    cors_allowed_origins=SOCKETIO_CORS_ALLOWED_ORIGINS
+    cors_allowed_origins=SOCKETIO_CORS_ALLOWED_ORIGINS,
+    transports=SOCKETIO_TRANSPORTS
 )
 # sio.instrument(auth={
 #     'username': 'admin',
 #     'password': "admin",
 # })
 server = socketio.ASGIApp(sio)
+writer = MessageWriter(sio) if MONGODB_WRITE_BEHIND else None
+coalescer = Coalescer(sio)
 
 
-if SOCKETIO_DEBUG:
-    from core.logging import log
+def event(handler):
+    """
+    Registers the handler like `sio.event`, recording its latency per event name.
+    Events listed in SOCKETIO_RATE_LIMITS are refused with an `error` event once the user runs out of tokens.
+    Returns the handler itself, so the decorated name stays callable.
+    """
+
+    name, registered = handler.__name__, handler
+    if name in SOCKETIO_RATE_LIMITS:
+        @wraps(handler)
+        async def registered(sid, *args):
+            allowed, retry_after = await limits.acquire(name, presence.local.get(sid, sid))
+            if not allowed:
+                detail = {**rate_limited_error["data"]["detail"], "event": name, "retry_after": retry_after}
+                return await sio.emit("error", {"detail": detail}, to=sid)
+            return await handler(sid, *args)
+
+    sio.on(name, handler=timed(SOCKETIO_EVENT_DURATION, name)(registered))
+    return handler
+
+
+def count_rooms() -> int:
+    rooms = sio.manager.rooms.get("/", {})
+    return sum(1 for room in rooms if room is not None and room not in rooms.get(None, {}))
 
+
+Gauge("chat_socketio_rooms", "Rooms with at least one socket on this worker.", callback=count_rooms)
+
+
+@asynccontextmanager
+async def lifespan():
+    if writer is not None:
+        await writer.start()
+    heartbeat = asyncio.create_task(presence.heartbeat())
+    await coalescer.start()
+    try:
+        yield
+    finally:
+        await drain()
+        await coalescer.stop()
+        heartbeat.cancel()
+        with suppress(asyncio.CancelledError):
+            await heartbeat
+        await presence.clear()
+        if writer is not None:
+            await writer.stop()
+
+
+async def drain():
+    """
+    Disconnects the sockets of this worker while MongoDB and Redis are still open,
+    so every disconnect handler runs before the worker exits.
+    """
+
+    sids = [sid for sid, _ in sio.manager.get_participants("/", None)] if "/" in sio.manager.rooms else []
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(*(sio.disconnect(sid) for sid in sids), return_exceptions=True),
+            SOCKETIO_SHUTDOWN_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        log.warning(f"Timed out draining {len(sids)} Socket.IO connections.")
+    await sio.shutdown()
+
+
+if SOCKETIO_DEBUG:
     @sio.on('*')
     async def any_event(event, sid, data):
         log.info(f"{event=} | {sid=} | {data=}")
 
 
-@sio.event
+@event
 async def connect(sid, environ):
     token = environ.get("HTTP_AUTHORIZATION")
     if not token or not token.startswith("Bearer "):
         raise ConnectionRefusedError(authentication_failed_error)
     token = token.split(" ")[1]
 
+    # The handshakes beyond the admission capacity wait in a bounded queue, or are refused right away.
     try:
-        user = await mongodb.Manager.get_or_create(
-            "users",
-            verified_access_token(token)
-        )
-    except (EntityAlreadyExistsError):
-        raise ConnectionRefusedError(entity_already_exists_error)
-
-    await redis.Manager.get_db().set(
-        sid,
-        json.dumps(
-            {
-                "_id": str(user["_id"]),
-                "username": user["username"]
-            }
-        ))
-
-
-@sio.event
+        async with limits.admission():
+            payload = verified_access_token(token)
+            if (user := await get_cached_user(payload["username"])) is None or user["email"] != payload["email"]:
+                try:
+                    user = await cache_user(await mongodb.Manager.get_or_create("users", payload))
+                except (EntityAlreadyExistsError):
+                    raise ConnectionRefusedError(entity_already_exists_error)
+            user_rooms = await rooms.user_rooms(str(user["_id"]))
+    except limits.OverloadedError:
+        raise ConnectionRefusedError(overloaded_error)
+
+    # Rejoin the rooms before going online: once online, the messages are no longer queued for replay.
+    for room_id in user_rooms:
+        await sio.enter_room(sid, room_id)
+    await presence.add(sid, user)
+    SOCKETIO_CONNECTED_SOCKETS.inc()
+    sio.start_background_task(delivery.replay, sio, sid, str(user["_id"]))
+
+
+@event
 async def disconnect(sid):
-    await redis.Manager.get_db().delete(sid)
+    SOCKETIO_CONNECTED_SOCKETS.dec()
+    coalescer.forget(sid)
+    await presence.remove(sid)
 
 
-@sio.event
+@event
 async def private_room(sid, data):
-    sender_id = json.loads(await redis.Manager.get_db().get(sid)["_id"])
+    if (user := await presence.get(sid)) is None:
+        return await sio.emit("error", "User is not authenticated.", to=sid)
+    sender_id = user["_id"]
 
     if (receiver_username := data.get("receiver")) is None:
         return await sio.emit(**receiver_required_error, to=sid)
 
-    try:
-        receiver = mongodb.Manager.get_or_fail(
-            "users",
-            {"username": receiver_username}
-        )
-    except EntityDoesNotExistError:
-        return await sio.emit(**entity_does_not_exist_error, to=sid)
+    if (receiver := await get_cached_user(receiver_username)) is None:
+        try:
+            receiver = await cache_user(await mongodb.Manager.get_or_fail(
+                MONGODB_COLLECTION_USERS,
+                {"username": receiver_username}
+            ))
+        except EntityDoesNotExistError:
+            return await sio.emit(**entity_does_not_exist_error, to=sid)
     receiver_id = str(receiver["_id"])
 
     if sender_id == receiver_id:
         return await sio.emit(**sender_is_receiver_error, to=sid)
 
-    room = await mongodb.Manager.get_or_create("rooms", {
+    participants = sorted([sender_id, receiver_id])
+    room = await mongodb.Manager.get_or_create(MONGODB_COLLECTION_ROOMS, {
+        "_id": rooms.private_room_id(participants),
         "type": "private",
-        "participants": sorted([sender_id, receiver_id])
+        "participants": participants
     })
+    await rooms.cache_members(room["_id"], participants)
+    await add_room_to_inbox(mongodb.Manager.get_db(), room["_id"], participants)
 
-    await mongodb.Manager.get_db()["users"].update_one({"_id": sender_id}, {"$addToSet": {"rooms": room["_id"]}})
-    await mongodb.Manager.get_db()["users"].update_one({"_id": receiver_id}, {"$addToSet": {"rooms": room["_id"]}})
+    await mongodb.Manager.get_db()[MONGODB_COLLECTION_USERS].update_many(
+        {"_id": {"$in": [bson.ObjectId(p) for p in participants]}},
+        {"$addToSet": {"rooms": room["_id"]}}
+    )
+    # After the MongoDB update, so a room set loaded concurrently either includes the room or receives it here.
+    await rooms.add_user_room(room["_id"], participants)
 
     room_id = str(room["_id"])
     await sio.enter_room(sid, room_id)
+    for receiver_sid in await presence.sids(receiver_id):
+        await sio.enter_room(receiver_sid, room_id)
     return room_id
 
 
-@sio.event
+@event
 async def private_message(sid, data):
-    if (user := await redis.Manager.get_db().get(sid)) is None:
+    if (user := await presence.get(sid)) is None:
         return await sio.emit("error", "Authentication required.", to=sid)
-    sender = json.loads(user)["username"]
+    sender, sender_id = user["username"], user["_id"]
 
     room = data.get("room")
     message = data.get("message")
@@ -118,35 +244,141 @@ async def private_message(sid, data):
     except bson.errors.InvalidId:
         return await sio.emit("error", "Invalid room object id.", to=sid)
 
-    # return await Manager.get_db()["rooms"].update_one(
-    #     {"_id": room_id},
-    #     {"$push": {"messages": {
-    #         "sender": sender,
-    #         "message": message,
-    #         "timestamp": dt.datetime.now(dt.timezone.utc)
-    #     }}}
-    # )
-
-    res = await add_message_to_room(mongodb.Manager.get_db(), room_id, sender, message)
-    if res.matched_count != 1:
+    if (participants := await rooms.get_members(room_id)) is None:
         return await sio.emit("error", "Room does not exist.", to=sid)
+    if sender_id not in participants:
+        return await sio.emit(**not_a_member_error, to=sid)
+    participants = list(participants)
+
+    mdb = mongodb.Manager.get_db()
 
-    await sio.emit("private_message", data=message, room=room)
+    if writer is None:
+        message = await add_message_to_room(mdb, room_id, sender, message)
+        await add_message_to_inbox(mdb, room_id, sender_id, participants, message)
+        await sio.emit("private_message", data=message["message"], room=room)
+    else:
+        message = new_message(sender, message)
+        await sio.emit("private_message", data=message["message"], room=room)
+        await writer.put(sid, room_id, sender_id, participants, message)
+    await delivery.enqueue(room_id, sender_id, participants, message)
+    search.add(room_id, message)
+    return str(message["_id"])
+
+
+@event
+async def pending_messages(sid, _):
+    if (user := await presence.get(sid)) is None:
+        return await sio.emit("error", "User is not authenticated.", to=sid)
+    await delivery.replay(sio, sid, user["_id"])
+
+
+@event
+async def delivery_ack(sid, data):
+    if (user := await presence.get(sid)) is None:
+        return await sio.emit("error", "User is not authenticated.", to=sid)
+    if not isinstance(entry_id := data.get("ack"), str) or not re.fullmatch(r"\d+-\d+", entry_id):
+        return await sio.emit("error", "A valid ack id is required.", to=sid)
+    await delivery.ack(user["_id"], entry_id)
+
+
+def serialize_inbox_entry(entry: dict) -> dict:
+    return {
+        "room": str(entry["room"]),
+        "participants": entry["participants"],
+        "last_message": (
+            None if (last_message := entry["last_message"]) is None else {**last_message, "_id": str(last_message["_id"])}
+        ),
+        "timestamp": serialize_timestamp(entry["timestamp"]),
+        "unread": entry["unread"]
+    }
+
+
+@event
+async def previous_rooms(sid, data):
+    if (user := await presence.get(sid)) is None:
+        return await sio.emit("error", "User is not authenticated.", to=sid)
+
+    after = None
+    if (cursor := (data or {}).get("cursor")) is not None:
+        try:
+            after = decode_cursor(cursor, datetime, bson.ObjectId)
+        except ValueError:
+            return await sio.emit("error", "Invalid cursor.", to=sid)
+
+    entries = await get_inbox(mongodb.Manager.get_db(), user["_id"], SOCKETIO_PREVIOUS_ROOMS_PAGE_SIZE, after)
+    if len(entries) < SOCKETIO_PREVIOUS_ROOMS_PAGE_SIZE:
+        cursor = None
+    else:
+        cursor = encode_cursor([entries[-1]["timestamp"], entries[-1]["room"]])
+    return {"rooms": [serialize_inbox_entry(entry) for entry in entries], "cursor": cursor}
 
 
-@sio.event
-async def previous_rooms(sid, _):
-    if (user := await redis.Manager.get_db().get(sid)) is None:
+@event
+async def room_history(sid, data):
+    if (user := await presence.get(sid)) is None:
         return await sio.emit("error", "User is not authenticated.", to=sid)
+    user_id = user["_id"]
+
+    if (room := data.get("room")) is None:
+        return await sio.emit("error", "Room is required.", to=sid)
+
+    try:
+        room_id = bson.ObjectId(room)
+    except bson.errors.InvalidId:
+        return await sio.emit("error", "Invalid room object id.", to=sid)
+
+    before = None
+    if (cursor := data.get("cursor")) is not None:
+        try:
+            before = tuple(decode_cursor(cursor, datetime, bson.ObjectId))
+        except ValueError:
+            return await sio.emit("error", "Invalid cursor.", to=sid)
+
+    if (participants := await rooms.get_members(room_id)) is None:
+        return await sio.emit("error", "Room does not exist.", to=sid)
+    if user_id not in participants:
+        return await sio.emit(**not_a_member_error, to=sid)
 
-    _id = bson.ObjectId(json.loads(user)["_id"])
     mdb = mongodb.Manager.get_db()
 
-    if (user := await mdb["users"].find_one({"_id": _id})) is None:
-        return await sio.emit("error", "User does not exist.", to=sid)
+    messages = await get_room_messages(mdb, room_id, SOCKETIO_ROOM_HISTORY_PAGE_SIZE, before)
+    if before is None:
+        await mdb[MONGODB_COLLECTION_INBOX].update_one({"user": user_id, "room": room_id}, {"$set": {"unread": 0}})
+    if len(messages) < SOCKETIO_ROOM_HISTORY_PAGE_SIZE:
+        cursor = None
+    else:
+        cursor = encode_cursor([messages[-1]["timestamp"], messages[-1]["_id"]])
+    return {"messages": [serialize_message(message) for message in messages], "cursor": cursor}
+
+
+@event
+async def search_messages(sid, data):
+    if (user := await presence.get(sid)) is None:
+        return await sio.emit("error", "User is not authenticated.", to=sid)
+
+    query, page = data.get("query"), data.get("page", 0)
+    if not isinstance(query, str) or not 0 < len(query) <= 100:
+        return await sio.emit("error", "Query must be a string of 1 to 100 characters.", to=sid)
+    if not isinstance(page, int) or not 0 <= page <= 100:
+        return await sio.emit("error", "Page must be an integer between 0 and 100.", to=sid)
+
+    return await search.search(user["_id"], query, page)
+
+
+@event
+async def ephemeral(sid, data):
+    """
+    Typing indicators and similar signals. They are checked against local state only, never reach MongoDB
+    or Redis, and are relayed to the room in coalesced frames by the `coalescer`.
+    """
+
+    if (user_id := presence.local.get(sid)) is None:
+        return await sio.emit("error", "User is not authenticated.", to=sid)
 
-    if (rooms := user.get("rooms")) is None:
-        return []
+    room, event_type = data.get("room"), data.get("type")
+    if event_type not in SOCKETIO_EPHEMERAL_TYPES:
+        return await sio.emit("error", f"Type must be one of {SOCKETIO_EPHEMERAL_TYPES}.", to=sid)
+    if room is None or room not in sio.rooms(sid):
+        return await sio.emit(**not_a_member_error, to=sid)
 
-    rooms = await mdb["rooms"].find({"_id": {"$in": rooms}}).to_list(length=None)
-    return [room["type"] for room in rooms]
+    coalescer.push(sid, room, {"user": user_id, "type": event_type, "state": data.get("state")})
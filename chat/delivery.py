@@ -0,0 +1,78 @@
+from typing import Any, List
+import asyncio
+import json
+
+import bson
+
+from core import redis
+from core.settings import (
+    REDIS_DELIVERY_PREFIX,
+    REDIS_DELIVERY_MAX_LENGTH,
+    REDIS_DELIVERY_TTL,
+    SOCKETIO_REPLAY_BATCH_SIZE,
+    SOCKETIO_REPLAY_MAX_FRAMES,
+    SOCKETIO_REPLAY_MAX_CONCURRENCY
+)
+from .utils import serialize_message
+from . import presence
+
+
+# Bounds the replays running at once on this worker, so a reconnect storm is served at a steady pace.
+replays = asyncio.Semaphore(SOCKETIO_REPLAY_MAX_CONCURRENCY)
+
+
+def queue_key(user_id: str) -> str:
+    return f"{REDIS_DELIVERY_PREFIX}:{user_id}"
+
+
+def next_id(entry_id: str) -> str:
+    ms, seq = entry_id.split("-")
+    return f"{ms}-{int(seq) + 1}"
+
+
+async def enqueue(room_id: bson.ObjectId, sender_id: str, participants: List[str], message: dict) -> None:
+    """
+    Appends the message to the pending-delivery stream of every participant who is offline.
+    """
+
+    recipients = [p for p in participants if p != sender_id]
+    offline = [user_id for user_id, is_online in (await presence.online(recipients)).items() if not is_online]
+    if not offline:
+        return
+
+    entry = {"message": json.dumps({"room": str(room_id), **serialize_message(message)})}
+    async with redis.Manager.get_db().pipeline(transaction=False) as pipe:
+        for user_id in offline:
+            pipe.xadd(queue_key(user_id), entry, maxlen=REDIS_DELIVERY_MAX_LENGTH, approximate=True)
+            pipe.expire(queue_key(user_id), REDIS_DELIVERY_TTL)
+        await pipe.execute()
+
+
+async def replay(sio: Any, sid: str, user_id: str) -> None:
+    """
+    Emits the pending messages of the user as `pending_messages` frames of at most SOCKETIO_REPLAY_BATCH_SIZE
+    messages, and at most SOCKETIO_REPLAY_MAX_FRAMES frames per call. Each frame carries the `ack` id to send
+    back with `delivery_ack`; the client can ask for the rest with `pending_messages`.
+    """
+
+    db = redis.Manager.get_db()
+    async with replays:
+        start = "-"
+        for _ in range(SOCKETIO_REPLAY_MAX_FRAMES):
+            entries = await db.xrange(queue_key(user_id), min=start, count=SOCKETIO_REPLAY_BATCH_SIZE)
+            if not entries:
+                return
+            await sio.emit(
+                "pending_messages",
+                data={"messages": [json.loads(fields["message"]) for _, fields in entries], "ack": entries[-1][0]},
+                to=sid
+            )
+            start = next_id(entries[-1][0])
+
+
+async def ack(user_id: str, entry_id: str) -> None:
+    """
+    Trims every pending message up to and including `entry_id`.
+    """
+
+    await redis.Manager.get_db().xtrim(queue_key(user_id), minid=next_id(entry_id), approximate=False)
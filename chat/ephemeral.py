@@ -0,0 +1,99 @@
+from collections import defaultdict
+from typing import Any
+import asyncio
+import time
+
+from core.logging import log
+from core.settings import SOCKETIO_EPHEMERAL_WINDOW, SOCKETIO_EPHEMERAL_TICK
+
+
+class Coalescer:
+    """
+    Fan-out of short-lived signals (typing indicators, presence pings) which are never persisted.
+
+    Updates of one (sid, room) are throttled to one per `window` seconds. The latest throttled update is held
+    and sent once the window has passed, so the final state (e.g. a typing stop) always reaches the room.
+    The updates of a room collected during a tick are emitted together as a single `ephemeral` frame.
+    """
+
+    def __init__(self, sio: Any, window: float = SOCKETIO_EPHEMERAL_WINDOW, tick: float = SOCKETIO_EPHEMERAL_TICK):
+        self.sio = sio
+        self.window = window
+        self.tick = tick
+        self.pending = defaultdict(dict)
+        self.held = defaultdict(dict)
+        self.last = defaultdict(dict)
+        self.task = None
+
+    def push(self, sid: str, room: str, event: dict) -> bool:
+        """
+        Queues the event for the next frame of the room. Returns False if it was throttled,
+        in which case it is held until the window of the (sid, room) has passed.
+        """
+
+        now = time.monotonic()
+        if now - self.last[sid].get(room, float("-inf")) < self.window:
+            self.held[sid][room] = event
+            return False
+        self.last[sid][room] = now
+        self.pending[room][sid] = event
+        if sid in self.held:
+            self.held[sid].pop(room, None)
+        return True
+
+    def forget(self, sid: str) -> None:
+        # Every pending event of the sid has a `last` entry, so only its own rooms are visited.
+        for room in self.last.pop(sid, {}):
+            if room in self.pending:
+                self.pending[room].pop(sid, None)
+        self.held.pop(sid, None)
+
+    def release(self, now: float) -> None:
+        """
+        Moves the held updates whose window has passed into the pending frames.
+        """
+
+        for sid, events in list(self.held.items()):
+            for room in [room for room in events if now - self.last[sid].get(room, float("-inf")) >= self.window]:
+                self.pending[room][sid] = events.pop(room)
+                self.last[sid][room] = now
+            if not events:
+                del self.held[sid]
+
+    async def flush(self) -> None:
+        self.release(time.monotonic())
+        pending, self.pending = self.pending, defaultdict(dict)
+        await asyncio.gather(
+            *(
+                self.sio.emit("ephemeral", data={"room": room, "events": list(events.values())}, room=room)
+                for room, events in pending.items() if events
+            ),
+            return_exceptions=True
+        )
+
+        deadline = time.monotonic() - self.window
+        for sid, rooms in list(self.last.items()):
+            held = self.held.get(sid, {})
+            self.last[sid] = {room: seen for room, seen in rooms.items() if seen >= deadline or room in held}
+            if not self.last[sid]:
+                del self.last[sid]
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                await self.flush()
+            except Exception as e:
+                log.error(f"Failed to flush ephemeral events: {e}")
+
+    async def start(self) -> None:
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
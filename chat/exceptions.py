@@ -52,3 +52,47 @@ sender_is_receiver_error = {
         }
     }
 }
+
+message_not_persisted_error = {
+    "event": "error",
+    "data": {
+        "detail": {
+            "type": "MessageNotPersistedError",
+            "message": "The messages were delivered but could not be saved.",
+            "resolution": "Please send the listed messages again."
+        }
+    }
+}
+
+not_a_member_error = {
+    "event": "error",
+    "data": {
+        "detail": {
+            "type": "NotAMemberError",
+            "message": "You are not a participant of this room.",
+            "resolution": "Join the room with the private_room event first."
+        }
+    }
+}
+
+rate_limited_error = {
+    "event": "error",
+    "data": {
+        "detail": {
+            "type": "RateLimitedError",
+            "message": "Too many requests.",
+            "resolution": "Wait for the given number of seconds before trying again."
+        }
+    }
+}
+
+overloaded_error = {
+    "event": "error",
+    "data": {
+        "detail": {
+            "type": "OverloadedError",
+            "message": "The server is busy.",
+            "resolution": "Please connect again in a few seconds."
+        }
+    }
+}
@@ -0,0 +1,116 @@
+from contextlib import asynccontextmanager
+from typing import Optional, Tuple
+import asyncio
+
+from redis.commands.core import AsyncScript
+
+from core import redis
+from core.logging import log
+from core.metrics import Gauge, SOCKETIO_RATE_LIMITED, SOCKETIO_ADMISSION_REJECTED
+from core.settings import (
+    REDIS_RATE_LIMIT_PREFIX,
+    SOCKETIO_RATE_LIMIT,
+    SOCKETIO_RATE_LIMITS,
+    SOCKETIO_ADMISSION_MAX_CONCURRENCY,
+    SOCKETIO_ADMISSION_MAX_QUEUE,
+    SOCKETIO_ADMISSION_TIMEOUT
+)
+
+
+# Refills the bucket for the time elapsed since the last call, then takes a token if there is one.
+# The clock of the Redis server is used, so every worker of the cluster sees the same buckets.
+# Returns whether the call is allowed, and the seconds until the next token otherwise.
+TOKEN_BUCKET = """
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = math.min(burst, (tonumber(state[1]) or burst) + math.max(0, now - (tonumber(state[2]) or now)) * rate)
+local allowed, retry_after = 0, (1 - tokens) / rate
+if tokens >= 1 then
+    allowed, tokens, retry_after = 1, tokens - 1, 0
+end
+redis.call("HSET", KEYS[1], "tokens", tokens, "ts", now)
+redis.call("PEXPIRE", KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return {allowed, tostring(retry_after)}
+"""
+script: Optional[AsyncScript] = None
+enabled = SOCKETIO_RATE_LIMIT
+
+
+class OverloadedError(Exception):
+    pass
+
+
+def bucket_key(event: str, user_id: str) -> str:
+    return f"{REDIS_RATE_LIMIT_PREFIX}:{event}:{user_id}"
+
+
+async def acquire(event: str, user_id: str) -> Tuple[bool, float]:
+    """
+    Takes a token from the bucket of the user for the event. Returns whether the call is allowed,
+    and the seconds to wait before retrying otherwise. Events without a limit are always allowed,
+    and so is everything while the limiter is disabled.
+    """
+
+    global script
+
+    if not enabled or (limit := SOCKETIO_RATE_LIMITS.get(event)) is None:
+        return True, 0
+    db = redis.Manager.get_db()
+    if script is None or script.registered_client is not db:
+        script = db.register_script(TOKEN_BUCKET)
+
+    try:
+        allowed, retry_after = await script(keys=[bucket_key(event, user_id)], args=list(limit))
+    except Exception as e:
+        # Failing open: an unavailable limiter must not take the chat down with it.
+        log.warning(f"Rate limiter unavailable, allowing {event} of {user_id}: {e!r}")
+        return True, 0
+    if not allowed:
+        SOCKETIO_RATE_LIMITED.inc(event)
+    return bool(allowed), float(retry_after)
+
+
+class Admission:
+    """
+    Bounds the handshakes processed at once. Up to `max_queue` further handshakes wait for a slot,
+    for at most `timeout` seconds, and the ones beyond are refused at once with OverloadedError.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = SOCKETIO_ADMISSION_MAX_CONCURRENCY,
+        max_queue: int = SOCKETIO_ADMISSION_MAX_QUEUE,
+        timeout: float = SOCKETIO_ADMISSION_TIMEOUT
+    ):
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.waiting = 0
+
+    @asynccontextmanager
+    async def __call__(self):
+        if self.slots.locked():
+            if self.waiting >= self.max_queue:
+                SOCKETIO_ADMISSION_REJECTED.inc("queue_full")
+                raise OverloadedError
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self.slots.acquire(), self.timeout)
+            except asyncio.TimeoutError:
+                SOCKETIO_ADMISSION_REJECTED.inc("timeout")
+                raise OverloadedError
+            finally:
+                self.waiting -= 1
+        else:
+            await self.slots.acquire()
+
+        try:
+            yield
+        finally:
+            self.slots.release()
+
+
+admission = Admission()
+Gauge("chat_socketio_admission_waiting", "Handshakes waiting for an admission slot.", callback=lambda: admission.waiting)
@@ -0,0 +1,113 @@
+from typing import Iterable
+import asyncio
+import json
+import time
+
+from core import redis
+from core.logging import log
+from core.settings import REDIS_PRESENCE_PREFIX, SOCKETIO_PING_INTERVAL, SOCKETIO_PING_TIMEOUT
+
+
+TTL = SOCKETIO_PING_INTERVAL + SOCKETIO_PING_TIMEOUT
+ONLINE = f"{REDIS_PRESENCE_PREFIX}:online"
+
+# The sockets connected to this worker, sid -> user object id.
+# Only these keys are refreshed by the heartbeat and removed on shutdown.
+local: dict = {}
+
+
+def sid_key(sid: str) -> str:
+    return f"{REDIS_PRESENCE_PREFIX}:sid:{sid}"
+
+
+def user_key(user_id: str) -> str:
+    return f"{REDIS_PRESENCE_PREFIX}:user:{user_id}"
+
+
+async def add(sid: str, user: dict) -> None:
+    user_id = str(user["_id"])
+    local[sid] = user_id
+    async with redis.Manager.get_db().pipeline(transaction=False) as pipe:
+        pipe.set(sid_key(sid), json.dumps({"_id": user_id, "username": user["username"]}), ex=TTL)
+        pipe.sadd(user_key(user_id), sid)
+        pipe.expire(user_key(user_id), TTL)
+        pipe.zadd(ONLINE, {user_id: time.time()})
+        await pipe.execute()
+
+
+async def get(sid: str) -> dict | None:
+    if (user := await redis.Manager.get_db().get(sid_key(sid))) is None:
+        return None
+    return json.loads(user)
+
+
+async def remove(sid: str) -> None:
+    if (user_id := local.pop(sid, None)) is None:
+        if (user := await get(sid)) is None:
+            return
+        user_id = user["_id"]
+
+    db = redis.Manager.get_db()
+    async with db.pipeline(transaction=False) as pipe:
+        pipe.delete(sid_key(sid))
+        pipe.srem(user_key(user_id), sid)
+        pipe.scard(user_key(user_id))
+        *_, remaining = await pipe.execute()
+    if remaining == 0:
+        await db.zrem(ONLINE, user_id)
+
+
+async def sids(user_id: str) -> set:
+    """
+    Returns the live sids of the user on every worker.
+    """
+
+    db = redis.Manager.get_db()
+    if not (members := list(await db.smembers(user_key(user_id)))):
+        return set()
+    async with db.pipeline(transaction=False) as pipe:
+        for sid in members:
+            pipe.exists(sid_key(sid))
+        return {sid for sid, exists in zip(members, await pipe.execute()) if exists}
+
+
+async def online(user_ids: Iterable[str]) -> dict:
+    """
+    Returns whether each user has sent a heartbeat within the ping timeout, in a single round trip.
+    """
+
+    if not (user_ids := list(user_ids)):
+        return {}
+    deadline = time.time() - TTL
+    scores = await redis.Manager.get_db().zmscore(ONLINE, user_ids)
+    return {user_id: score is not None and score >= deadline for user_id, score in zip(user_ids, scores)}
+
+
+async def heartbeat() -> None:
+    """
+    Refreshes the presence of the sockets connected to this worker every ping interval.
+    Keys of a worker which stopped without cleaning up expire after the ping timeout.
+    """
+
+    while True:
+        await asyncio.sleep(SOCKETIO_PING_INTERVAL)
+        now = time.time()
+        try:
+            async with redis.Manager.get_db().pipeline(transaction=False) as pipe:
+                for sid, user_id in list(local.items()):
+                    pipe.expire(sid_key(sid), TTL)
+                    pipe.expire(user_key(user_id), TTL)
+                if local:
+                    pipe.zadd(ONLINE, {user_id: now for user_id in local.values()})
+                pipe.zremrangebyscore(ONLINE, "-inf", now - TTL)
+                await pipe.execute()
+        except Exception as e:
+            log.error(f"Presence heartbeat failed: {e}")
+
+
+async def clear() -> None:
+    """
+    Removes the presence of the sockets connected to this worker, leaving other workers untouched.
+    """
+
+    await asyncio.gather(*(remove(sid) for sid in list(local)), return_exceptions=True)
@@ -0,0 +1,86 @@
+from typing import List
+import hashlib
+
+import bson
+
+from core import mongodb, redis
+from core.settings import (
+    MONGODB_COLLECTION_USERS,
+    MONGODB_COLLECTION_ROOMS,
+    REDIS_ROOM_MEMBERS_PREFIX,
+    REDIS_ROOM_MEMBERS_TTL,
+    REDIS_USER_ROOMS_PREFIX,
+    REDIS_USER_ROOMS_TTL
+)
+
+
+# Adds the room to the cached room sets only, creating a set here would hide the other rooms of the user.
+ADD_IF_CACHED = """
+for _, key in ipairs(KEYS) do
+    if redis.call("EXISTS", key) == 1 then
+        redis.call("SADD", key, ARGV[1])
+    end
+end
+"""
+
+
+def private_room_id(participants: List[str]) -> bson.ObjectId:
+    """
+    Derives the room id from the sorted participant pair, so a private room resolves with a single `_id` lookup.
+    """
+
+    return bson.ObjectId(hashlib.sha256(":".join(sorted(participants)).encode()).digest()[:12])
+
+
+def members_key(room_id: bson.ObjectId) -> str:
+    return f"{REDIS_ROOM_MEMBERS_PREFIX}:{room_id}:members"
+
+
+async def cache_members(room_id: bson.ObjectId, participants: List[str]) -> None:
+    async with redis.Manager.get_db().pipeline(transaction=False) as pipe:
+        pipe.sadd(members_key(room_id), *participants)
+        pipe.expire(members_key(room_id), REDIS_ROOM_MEMBERS_TTL)
+        await pipe.execute()
+
+
+async def get_members(room_id: bson.ObjectId) -> set | None:
+    """
+    Returns the participants of the room from Redis, loading them from MongoDB on a miss.
+    Returns None if the room does not exist.
+    """
+
+    if members := await redis.Manager.get_db().smembers(members_key(room_id)):
+        return members
+
+    room = await mongodb.Manager.get_db()[MONGODB_COLLECTION_ROOMS].find_one({"_id": room_id}, {"participants": 1})
+    if room is None:
+        return None
+    await cache_members(room_id, room["participants"])
+    return set(room["participants"])
+
+
+def user_rooms_key(user_id: str) -> str:
+    return f"{REDIS_USER_ROOMS_PREFIX}:{user_id}"
+
+
+async def add_user_room(room_id: bson.ObjectId, participants: List[str]) -> None:
+    await redis.Manager.get_db().eval(ADD_IF_CACHED, len(participants), *map(user_rooms_key, participants), str(room_id))
+
+
+async def user_rooms(user_id: str) -> List[str]:
+    """
+    Returns the ids of the rooms the user participates in, so a new socket of the user can rejoin them.
+    They are cached in Redis and loaded from MongoDB on a miss. The cached set always holds an empty
+    member, so a user without any room is cached too.
+    """
+
+    if rooms := await redis.Manager.get_db().smembers(user_rooms_key(user_id)):
+        return [room_id for room_id in rooms if room_id]
+
+    user = await mongodb.Manager.get_db()[MONGODB_COLLECTION_USERS].find_one({"_id": bson.ObjectId(user_id)}, {"rooms": 1})
+    rooms = [str(room_id) for room_id in (user or {}).get("rooms", [])]
+    async with redis.Manager.get_db().pipeline(transaction=False) as pipe:
+        pipe.sadd(user_rooms_key(user_id), "", *rooms)
+        pipe.expire(user_rooms_key(user_id), REDIS_USER_ROOMS_TTL)
+        await pipe.execute()
+    return rooms
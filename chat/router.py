@@ -0,0 +1,27 @@
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, Query
+
+from auth.dependencies import get_user
+from . import search
+
+
+router = APIRouter()
+User = Annotated[dict, Depends(get_user)]
+
+
+@router.get(
+    "/search/",
+    response_description="Operation successful.",
+    description=(
+        "Returns the messages matching the query in the rooms the user participates in, best match first, "
+        "and `end`, which is true on the last page."
+    ),
+    summary="Search Messages"
+)
+async def search_messages(
+    user: User,
+    q: str = Query(..., min_length=1, max_length=100, description="Words to search for"),
+    page: int = Query(0, ge=0, le=100, description="Page number, starting from 0")
+):
+    return await search.search(str(user["_id"]), q, page)
@@ -0,0 +1,76 @@
+from collections import defaultdict
+import re
+
+import bson
+
+from core import mongodb
+from core.mongodb import search_messages
+from core.settings import SEARCH_BACKEND, SOCKETIO_SEARCH_PAGE_SIZE, MONGODB_COLLECTION_USERS
+from .utils import serialize_message
+
+
+def tokenize(text: str) -> list:
+    return re.findall(r"\w+", text.lower())
+
+
+class InvertedIndex:
+    """
+    In-process term -> messages index, used instead of the MongoDB text index when SEARCH_BACKEND is "memory".
+    It only knows the messages sent to this worker since it started, which is enough for local development.
+    """
+
+    def __init__(self):
+        self.postings = defaultdict(list)
+
+    def add(self, room_id: bson.ObjectId, message: dict) -> None:
+        for term in set(tokenize(str(message["message"]))):
+            self.postings[term].append((room_id, message))
+
+    def search(self, room_ids: set, terms: list, limit: int, skip: int = 0) -> tuple:
+        scores, matches = defaultdict(int), {}
+        for term in set(terms):
+            for room_id, message in self.postings.get(term, ()):
+                if room_id in room_ids:
+                    scores[message["_id"]] += 1
+                    matches[message["_id"]] = (room_id, message)
+
+        ranked = sorted(scores, key=lambda i: (scores[i], matches[i][1]["timestamp"]), reverse=True)
+        return [
+            {"room": matches[i][0], "score": scores[i], "message": matches[i][1]}
+            for i in ranked[skip:skip + limit]
+        ], skip + limit >= len(ranked)
+
+
+index = InvertedIndex() if SEARCH_BACKEND == "memory" else None
+
+
+def add(room_id: bson.ObjectId, message: dict) -> None:
+    if index is not None:
+        index.add(room_id, message)
+
+
+async def search(user_id: str, query: str, page: int = 0) -> dict:
+    """
+    Returns one page of the messages matching the query, restricted to the rooms the user participates in,
+    and `end`, which is true on the last page.
+    """
+
+    if not (terms := tokenize(query)):
+        return {"results": [], "end": True}
+
+    user = await mongodb.Manager.get_db()[MONGODB_COLLECTION_USERS].find_one({"_id": bson.ObjectId(user_id)}, {"rooms": 1})
+    if not (room_ids := (user or {}).get("rooms")):
+        return {"results": [], "end": True}
+
+    skip = page * SOCKETIO_SEARCH_PAGE_SIZE
+    if index is not None:
+        results, end = index.search(set(room_ids), terms, SOCKETIO_SEARCH_PAGE_SIZE, skip)
+    else:
+        results, end = await search_messages(mongodb.Manager.get_db(), room_ids, terms, SOCKETIO_SEARCH_PAGE_SIZE, skip)
+    return {
+        "results": [
+            {"room": str(res["room"]), "score": res["score"], "message": serialize_message(res["message"])}
+            for res in results
+        ],
+        "end": end
+    }
@@ -0,0 +1,18 @@
+from datetime import datetime, timezone
+
+
+def serialize_timestamp(timestamp: datetime) -> str:
+    # MongoDB stores UTC without the offset, and the driver returns it naive: render every timestamp
+    # with its offset, whether it was just created or read back.
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.isoformat()
+
+
+def serialize_message(message: dict) -> dict:
+    return {
+        "_id": str(message["_id"]),
+        "sender": message["sender"],
+        "message": message["message"],
+        "timestamp": serialize_timestamp(message["timestamp"])
+    }
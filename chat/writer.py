@@ -0,0 +1,138 @@
+from typing import Any
+from collections import defaultdict
+import asyncio
+
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError, BulkWriteError
+import bson
+
+from core import mongodb
+from core.mongodb import message_bucket_upsert, inbox_upsert
+from core.logging import log
+from core.settings import (
+    MONGODB_COLLECTION_MESSAGES,
+    MONGODB_COLLECTION_INBOX,
+    MONGODB_WRITE_BEHIND_BATCH_SIZE,
+    MONGODB_WRITE_BEHIND_WINDOW,
+    MONGODB_WRITE_BEHIND_MAX_PENDING
+)
+from .exceptions import message_not_persisted_error
+
+
+class MessageWriter:
+    """
+    Persists messages in the background, coalescing them into one `bulk_write` per batch.
+    Inbox entries of the same (user, room) within a batch are merged into a single upsert.
+
+    A batch is flushed once it holds `batch_size` messages or `window` seconds after its first message.
+    At most `max_pending` messages wait in memory; `put` blocks beyond that, which slows the senders down
+    to the speed of MongoDB. Senders receive a `message_ack` event once their messages are durable.
+    """
+
+    def __init__(
+        self,
+        sio: Any,
+        batch_size: int = MONGODB_WRITE_BEHIND_BATCH_SIZE,
+        window: float = MONGODB_WRITE_BEHIND_WINDOW,
+        max_pending: int = MONGODB_WRITE_BEHIND_MAX_PENDING
+    ):
+        self.sio = sio
+        self.batch_size = batch_size
+        self.window = window
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.task = None
+
+    async def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """
+        Flushes every pending message, then stops the background task.
+        """
+
+        if self.task is not None:
+            if not self.task.done():
+                await self.queue.put(None)
+            await self.task
+            self.task = None
+
+    async def put(self, sid: str, room_id: bson.ObjectId, sender_id: str, participants: list, message: dict):
+        await self.queue.put((sid, room_id, sender_id, participants, message))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while (item := await self.queue.get()) is not None:
+            batch, deadline = [item], loop.time() + self.window
+            while len(batch) < self.batch_size and (timeout := deadline - loop.time()) > 0:
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    return await self.flush(batch)
+                batch.append(item)
+            await self.flush(batch)
+
+    async def flush(self, batch: list):
+        """
+        Persists the batch and acknowledges it. Never raises, so one failed batch cannot stop the writer.
+        """
+
+        try:
+            persisted = await self.write(batch)
+        except Exception as e:
+            log.exception(f"Failed to persist a batch of {len(batch)} messages: {e}")
+            persisted = 0
+        await self.acknowledge(batch, persisted)
+
+    async def write(self, batch: list) -> int:
+        """
+        Writes the messages, then the inbox entries of the persisted ones. Returns the number of messages persisted,
+        which are always the first ones of the batch.
+        """
+
+        db = mongodb.Manager.get_db()
+        try:
+            await db[MONGODB_COLLECTION_MESSAGES].bulk_write(
+                [UpdateOne(*message_bucket_upsert(room_id, message), upsert=True) for _, room_id, _, _, message in batch],
+                ordered=True
+            )
+            persisted = len(batch)
+        except BulkWriteError as e:
+            # The writes are ordered, so every upsert before the first error went through, either inserting or matching a bucket.
+            persisted = e.details["nUpserted"] + e.details["nMatched"]
+            log.error(f"Persisted {persisted} of a batch of {len(batch)} messages: {e}")
+        if not persisted:
+            return 0
+
+        inbox = {}
+        for _, room_id, sender_id, participants, message in batch[:persisted]:
+            for p in participants:
+                unread = inbox[(p, room_id)][2] if (p, room_id) in inbox else 0
+                inbox[(p, room_id)] = (participants, message, unread + int(p != sender_id))
+        try:
+            await db[MONGODB_COLLECTION_INBOX].bulk_write(
+                [
+                    inbox_upsert(p, room_id, participants, message, unread)
+                    for (p, room_id), (participants, message, unread) in inbox.items()
+                ],
+                ordered=False
+            )
+        except PyMongoError as e:
+            # The messages are durable, the inbox entries catch up with the next message of the room.
+            log.error(f"Failed to update the inbox entries of {persisted} persisted messages: {e}")
+        return persisted
+
+    async def acknowledge(self, batch: list, persisted: int):
+        acks, lost = defaultdict(list), defaultdict(list)
+        for i, (sid, room_id, _, _, message) in enumerate(batch):
+            (acks if i < persisted else lost)[sid].append({"room": str(room_id), "_id": str(message["_id"])})
+
+        await asyncio.gather(
+            *(self.sio.emit("message_ack", data=messages, to=sid) for sid, messages in acks.items()),
+            *(
+                self.sio.emit("error", data={**message_not_persisted_error["data"], "messages": messages}, to=sid)
+                for sid, messages in lost.items()
+            ),
+            return_exceptions=True
+        )
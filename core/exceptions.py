@@ -1,4 +1,5 @@
-from fastapi import HTTPException, status
+from starlette.exceptions import HTTPException
+from starlette import status
 
 from .logging import log
 
@@ -63,3 +64,11 @@ class ActionForbiddenError(ChatAppAPIError):
     default_status_code = status.HTTP_403_FORBIDDEN
     default_detail = "You are not authorized to perform this action."
     default_resolution = "Check your permissions and try again."
+
+
+class InvalidCursorError(ChatAppAPIError):
+    """Raised when a pagination cursor cannot be decoded or does not match the requested ordering."""
+
+    default_status_code = status.HTTP_400_BAD_REQUEST
+    default_detail = "The given pagination cursor is invalid."
+    default_resolution = "Use a cursor returned by a previous page with the same ordering, and pass either `after` or `before`."
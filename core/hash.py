@@ -1,7 +1,16 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import time
+
 from passlib.context import CryptContext
 
+from .settings import HASH_MAX_WORKERS
+from .metrics import HASH_DURATION, Gauge
+
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+executor = ThreadPoolExecutor(max_workers=HASH_MAX_WORKERS, thread_name_prefix="hash")
+pending = 0
 
 
 def hash_password(password: str) -> str:
@@ -10,3 +19,38 @@ def hash_password(password: str) -> str:
 
 def is_valid_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
+
+
+def queue_depth() -> int:
+    """
+    Returns the number of hashing jobs waiting for a free worker thread.
+    """
+
+    return max(pending - HASH_MAX_WORKERS, 0)
+
+
+async def run_in_executor(func, *args, pool: ThreadPoolExecutor = None):
+    """
+    Runs the function on `pool`, by default the shared hashing pool whose queue depth is reported.
+    """
+
+    global pending
+    shared = pool is None
+    pending += shared
+    started = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool or executor, func, *args)
+    finally:
+        pending -= shared
+        HASH_DURATION.observe(time.perf_counter() - started, func.__name__)
+
+
+async def hash_password_async(password: str, pool: ThreadPoolExecutor = None) -> str:
+    return await run_in_executor(hash_password, password, pool=pool)
+
+
+async def is_valid_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await run_in_executor(is_valid_password, plain_password, hashed_password)
+
+
+Gauge("chat_hash_queue_depth", "Hashing jobs waiting for a free worker thread.", callback=queue_depth)
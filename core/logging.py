@@ -1,3 +1,4 @@
+import logging.config
 import logging
 
 from .settings import LOG_LEVEL
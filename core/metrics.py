@@ -0,0 +1,208 @@
+from typing import Callable, Dict, Iterable, List, Tuple
+from functools import wraps
+from bisect import bisect_left
+import asyncio
+import json
+import time
+import os
+
+from .logging import log
+from .settings import REDIS_METRICS_PREFIX, METRICS_PUBLISH_INTERVAL
+
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+registry: list = []
+
+
+class Metric:
+    """
+    Minimal Prometheus-style metric. Values are kept per tuple of label values, and recording one
+    is a dict lookup plus an addition, so the instrumentation is cheap enough for the hot paths.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        registry.append(self)
+
+    def label_string(self, values: Tuple[str, ...], extra: str = "") -> str:
+        # Every worker process keeps its own values, the `worker` label tells their series apart.
+        pairs = [f'{label}="{value}"' for label, value in zip(self.labels, values)] + [f'worker="{os.getpid()}"']
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}"
+
+    def samples(self) -> Iterable[str]:
+        for values, value in list(self.values.items()):
+            yield f"{self.name}{self.label_string(values)} {value}"
+
+    def render(self, others: Iterable[Dict[str, List[str]]] = ()) -> str:
+        return "\n".join([
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+            *self.samples(),
+            *(sample for snapshot in others for sample in snapshot.get(self.name, ()))
+        ])
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *values: str, amount: float = 1) -> None:
+        self.values[values] = self.values.get(values, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (), callback: Callable = None):
+        super().__init__(name, documentation, labels)
+        self.callback = callback
+
+    def set(self, value: float, *values: str) -> None:
+        self.values[values] = value
+
+    def inc(self, *values: str, amount: float = 1) -> None:
+        self.values[values] = self.values.get(values, 0) + amount
+
+    def dec(self, *values: str, amount: float = 1) -> None:
+        self.inc(*values, amount=-amount)
+
+    def samples(self) -> Iterable[str]:
+        if self.callback is not None:
+            self.values[()] = self.callback()
+        return super().samples()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, amount: float, *values: str) -> None:
+        if (state := self.values.get(values)) is None:
+            state = self.values[values] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect_left(self.buckets, amount)] += 1
+        state[1] += amount
+
+    def samples(self) -> Iterable[str]:
+        for values, (counts, total) in list(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{self.label_string(values, le)} {cumulative}"
+            yield f"{self.name}_sum{self.label_string(values)} {total}"
+            yield f"{self.name}_count{self.label_string(values)} {cumulative}"
+
+
+def timed(histogram: Histogram, *values: str) -> Callable:
+    """
+    Records the duration of every call of the decorated coroutine function in the histogram.
+    """
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            # Argument errors surface here, before anything is recorded.
+            coro = func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return await coro
+            finally:
+                histogram.observe(time.perf_counter() - started, *values)
+        return wrapper
+    return decorator
+
+
+def render(others: Iterable[Dict[str, List[str]]] = ()) -> str:
+    """
+    Renders the metrics of this worker, followed by the snapshots of the other workers under the same families.
+    """
+
+    others = list(others)
+    return "\n".join(metric.render(others) for metric in registry) + "\n"
+
+
+def snapshot() -> Dict[str, List[str]]:
+    return {metric.name: list(metric.samples()) for metric in registry}
+
+
+def worker_key(pid: int = None) -> str:
+    return f"{REDIS_METRICS_PREFIX}:{os.getpid() if pid is None else pid}"
+
+
+async def publish(db, interval: float = METRICS_PUBLISH_INTERVAL) -> None:
+    """
+    Stores a snapshot of the metrics of this worker in Redis every `interval` seconds, until cancelled.
+    The workers share the listening socket, so a scrape reaches any one of them: publishing lets the one
+    scraped answer for all. A snapshot expires after a few missed intervals, with its worker.
+    """
+
+    while True:
+        try:
+            await db.set(worker_key(), json.dumps(snapshot()), ex=int(interval * 3) + 1)
+        except Exception as e:
+            log.warning(f"Failed to publish the metrics of worker {os.getpid()}: {e!r}")
+        await asyncio.sleep(interval)
+
+
+async def collect(db) -> List[Dict[str, List[str]]]:
+    """
+    Returns the latest snapshots of the other workers, at most one publishing interval old.
+    """
+
+    keys = [key async for key in db.scan_iter(match=f"{REDIS_METRICS_PREFIX}:*") if key != worker_key()]
+    return [json.loads(value) for value in (await db.mget(keys) if keys else []) if value is not None]
+
+
+SOCKETIO_EVENT_DURATION = Histogram(
+    "chat_socketio_event_duration_seconds", "Latency of the Socket.IO event handlers.", ["event"]
+)
+SOCKETIO_CONNECTED_SOCKETS = Gauge(
+    "chat_socketio_connected_sockets", "Sockets connected to this worker."
+)
+SOCKETIO_RATE_LIMITED = Counter(
+    "chat_socketio_rate_limited_total", "Socket.IO events refused by the rate limiter.", ["event"]
+)
+SOCKETIO_ADMISSION_REJECTED = Counter(
+    "chat_socketio_admission_rejected_total", "Handshakes refused by the admission control.", ["reason"]
+)
+MONGODB_OPERATION_DURATION = Histogram(
+    "chat_mongodb_operation_duration_seconds", "Latency of the MongoDB manager operations.", ["operation"]
+)
+MONGODB_POOL_CHECKOUT_WAIT = Histogram(
+    "chat_mongodb_pool_checkout_wait_seconds", "Time spent waiting for a MongoDB pool connection."
+)
+MONGODB_SINGLEFLIGHT_REQUESTS = Counter(
+    "chat_mongodb_singleflight_requests_total", "Coalescable MongoDB reads, by whether they queried or joined an in-flight query.",
+    ["operation", "collection", "result"]
+)
+MONGODB_POOL_CHECKOUT_FAILURES = Counter(
+    "chat_mongodb_pool_checkout_failures_total", "Failed MongoDB pool checkouts.", ["address", "reason"]
+)
+MONGODB_POOL_MAX_SIZE = Gauge(
+    "chat_mongodb_pool_max_size", "The maximum size of the MongoDB pool.", ["address"]
+)
+MONGODB_POOL_CONNECTIONS = Gauge(
+    "chat_mongodb_pool_connections", "Open connections of the MongoDB pool.", ["address"]
+)
+MONGODB_POOL_CHECKED_OUT = Gauge(
+    "chat_mongodb_pool_checked_out", "Connections checked out of the MongoDB pool.", ["address"]
+)
+MONGODB_POOL_WAITING = Gauge(
+    "chat_mongodb_pool_waiting", "Operations waiting for a MongoDB pool connection.", ["address"]
+)
+REDIS_COMMAND_DURATION = Histogram(
+    "chat_redis_command_duration_seconds", "Latency of the Redis commands and pipelines.", ["command"]
+)
+HASH_DURATION = Histogram(
+    "chat_hash_duration_seconds", "Latency of the bcrypt operations, including the time queued.", ["operation"],
+    buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 1, 2.5, 5, 10)
+)
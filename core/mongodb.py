@@ -1,26 +1,135 @@
-from typing import Any, Literal, List, Tuple
+from typing import Any, Awaitable, Callable, Literal, List, Tuple, Dict, Union, ClassVar, Optional
+from collections import defaultdict
+from datetime import datetime, timezone
 from getpass import getpass
+from copy import deepcopy
+import threading
+import asyncio
+import base64
+import time
+import re
 
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
-from pymongo.errors import DuplicateKeyError
-from pymongo import ReturnDocument
-from bson import ObjectId
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from pymongo import ReturnDocument, UpdateOne, ASCENDING, DESCENDING, monitoring
+from bson import ObjectId, json_util
 from pydantic import BaseModel
 
-from core.exceptions import ChatAppAPIError, EntityDoesNotExistError, EntityAlreadyExistsError
-from core.settings import MONGODB_URL, MONGODB_MAX_POOL_SIZE, MONGODB_MIN_POOL_SIZE, MONGODB_DATABASE_NAME, MONGODB_COLLECTION_USERS
-from .hash import hash_password as hp
+from core.exceptions import ChatAppAPIError, EntityDoesNotExistError, EntityAlreadyExistsError, InvalidCursorError
+from core.settings import (
+    MONGODB_URL,
+    MONGODB_MAX_POOL_SIZE,
+    MONGODB_MIN_POOL_SIZE,
+    MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+    MONGODB_READ_PREFERENCE,
+    MONGODB_READ_CONCERN,
+    MONGODB_COMPRESSORS,
+    MONGODB_DATABASE_NAME,
+    MONGODB_COLLECTION_USERS,
+    MONGODB_COLLECTION_MESSAGES,
+    MONGODB_COLLECTION_INBOX,
+    MONGODB_MESSAGES_BUCKET_SIZE,
+    MONGODB_INBOX_PREVIEW_LENGTH,
+    MONGODB_SEARCH_MAX_BUCKETS,
+    MONGODB_SEARCH_MAX_CONCURRENCY,
+    MONGODB_SINGLEFLIGHT
+)
 from .logging import log
+from .metrics import (
+    timed,
+    MONGODB_OPERATION_DURATION,
+    MONGODB_SINGLEFLIGHT_REQUESTS,
+    MONGODB_POOL_CHECKOUT_WAIT,
+    MONGODB_POOL_CHECKOUT_FAILURES,
+    MONGODB_POOL_MAX_SIZE,
+    MONGODB_POOL_CONNECTIONS,
+    MONGODB_POOL_CHECKED_OUT,
+    MONGODB_POOL_WAITING
+)
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """
+    Records how long the operations wait to check a connection out of the pool, and how saturated
+    every pool is: the connections checked out against the maximum size, and the operations queued.
+
+    The driver publishes the events from its own threads, hence the lock around every metric update.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def address(event) -> str:
+        return ":".join(map(str, event.address))
+
+    def update(self, gauge, event, amount: int) -> None:
+        with self.lock:
+            gauge.inc(self.address(event), amount=amount)
+
+    def pool_created(self, event):
+        with self.lock:
+            MONGODB_POOL_MAX_SIZE.set(event.options.get("maxPoolSize", MONGODB_MAX_POOL_SIZE), self.address(event))
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        log.warning(f"MongoDB pool {self.address(event)} was cleared.")
+
+    def pool_closed(self, event):
+        with self.lock:
+            for gauge in (MONGODB_POOL_CONNECTIONS, MONGODB_POOL_CHECKED_OUT, MONGODB_POOL_WAITING):
+                gauge.values.pop((self.address(event),), None)
+
+    def connection_created(self, event):
+        self.update(MONGODB_POOL_CONNECTIONS, event, 1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.update(MONGODB_POOL_CONNECTIONS, event, -1)
+
+    def connection_check_out_started(self, event):
+        self.update(MONGODB_POOL_WAITING, event, 1)
+
+    def connection_checked_out(self, event):
+        with self.lock:
+            MONGODB_POOL_CHECKOUT_WAIT.observe(event.duration)
+            MONGODB_POOL_WAITING.dec(self.address(event))
+            MONGODB_POOL_CHECKED_OUT.inc(self.address(event))
+
+    def connection_check_out_failed(self, event):
+        with self.lock:
+            MONGODB_POOL_CHECKOUT_WAIT.observe(event.duration)
+            MONGODB_POOL_CHECKOUT_FAILURES.inc(self.address(event), event.reason)
+            MONGODB_POOL_WAITING.dec(self.address(event))
+        if event.reason == monitoring.ConnectionCheckOutFailedReason.TIMEOUT:
+            log.warning(f"MongoDB pool {self.address(event)} is saturated: a checkout timed out after {event.duration:.3f}s.")
+
+    def connection_checked_in(self, event):
+        self.update(MONGODB_POOL_CHECKED_OUT, event, -1)
 
 
 class Manager:
     _client: AsyncIOMotorClient = None
+    _inflight: Dict[tuple, asyncio.Task] = {}
 
     def __enter__(self):
+        options = {}
+        if MONGODB_READ_CONCERN is not None:
+            options["readConcernLevel"] = MONGODB_READ_CONCERN
+        if MONGODB_COMPRESSORS:
+            options["compressors"] = MONGODB_COMPRESSORS
         Manager._client = AsyncIOMotorClient(
             MONGODB_URL,
             maxPoolSize=MONGODB_MAX_POOL_SIZE,
-            minPoolSize=MONGODB_MIN_POOL_SIZE
+            minPoolSize=MONGODB_MIN_POOL_SIZE,
+            waitQueueTimeoutMS=MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+            readPreference=MONGODB_READ_PREFERENCE,
+            event_listeners=[PoolMonitor()],
+            **options
         )
         log.info("Connected to MongoDB.")
         return Manager._client
@@ -37,6 +146,8 @@ class Manager:
 
     @classmethod
     async def create_super_user(cls):
+        from .hash import hash_password as hp
+
         with cls() as client:
             username = input("Enter username: ")
             email = input("Enter email: ")
@@ -53,8 +164,30 @@ class Manager:
             log.info("Super user created successfully.")
 
     @classmethod
+    async def singleflight(cls, operation: str, collection: str, body: dict, query: Callable[[], Awaitable]) -> Any:
+        """
+        Runs `query`, unless an identical one is in flight, in which case its result is shared.
+        Only the query shapes listed in MONGODB_SINGLEFLIGHT are coalesced. Every caller gets its own copy
+        of the result, and cancelling a caller does not cancel the query the others are waiting on.
+        """
+
+        if tuple(sorted(body)) not in MONGODB_SINGLEFLIGHT.get(collection, ()):
+            return await query()
+
+        key = (operation, collection, tuple((field, json_util.dumps(body[field])) for field in sorted(body)))
+        if (task := cls._inflight.get(key)) is not None:
+            MONGODB_SINGLEFLIGHT_REQUESTS.inc(operation, collection, "coalesced")
+        else:
+            MONGODB_SINGLEFLIGHT_REQUESTS.inc(operation, collection, "queried")
+            task = cls._inflight[key] = asyncio.ensure_future(query())
+            task.add_done_callback(lambda _: cls._inflight.pop(key, None))
+        return deepcopy(await asyncio.shield(task))
+
+    @classmethod
+    @timed(MONGODB_OPERATION_DURATION, "get_or_fail")
     async def get_or_fail(cls, collection: str, body: dict, exc: ChatAppAPIError = None) -> dict:
-        if (res := await cls.get_db()[collection].find_one(body)) is not None:
+        res = await cls.singleflight("find_one", collection, body, lambda: cls.get_db()[collection].find_one(body))
+        if res is not None:
             return res
         else:
             if exc is not None:
@@ -65,13 +198,37 @@ class Manager:
                 )
 
     @classmethod
+    @timed(MONGODB_OPERATION_DURATION, "get_all_or_fail")
     async def get_all_or_fail(cls, collection: str, qp: Any) -> list:
+        """
+        Pages with `qp.after` or `qp.before` (cursors from `page_cursors`) when given, otherwise with `qp.skip`.
+        Keyset pages are served from the (order_by, _id) index and cost the same no matter how deep they are.
+        """
+
+        after, before = getattr(qp, "after", None), getattr(qp, "before", None)
+        sort = sort_keys(qp.order_by, qp.order_direction)
+        query, skip = {}, qp.skip
+        if after is not None and before is not None:
+            raise InvalidCursorError
+        if (cursor := after or before) is not None:
+            try:
+                values = decode_cursor(cursor)
+            except ValueError:
+                raise InvalidCursorError
+            if len(values) != len(sort):
+                raise InvalidCursorError
+            if before is not None:
+                sort = [(field, -direction) for field, direction in sort]
+            query, skip = keyset_filter(sort, values), 0
+
         res = await cls.get_db()[collection] \
-            .find() \
-            .sort(qp.order_by, qp.order_direction) \
-            .skip(qp.skip) \
+            .find(query) \
+            .sort(sort) \
+            .skip(skip) \
             .limit(qp.limit) \
             .to_list(length=qp.limit)
+        if before is not None:
+            res.reverse()
         if len(res) > 0:
             return res
         else:
@@ -80,6 +237,16 @@ class Manager:
             )
 
     @classmethod
+    async def stream(cls, collection: str, query: dict = None, projection: dict = None, batch_size: int = 1000):
+        """
+        Yields the matching documents one by one, holding at most `batch_size` of them in memory.
+        """
+
+        async for document in cls.get_db()[collection].find(query or {}, projection).batch_size(batch_size):
+            yield document
+
+    @classmethod
+    @timed(MONGODB_OPERATION_DURATION, "create_or_fail")
     async def create_or_fail(cls, collection: str, body: dict) -> dict:
         try:
             return await cls.get_db()[collection].insert_one(body)
@@ -87,6 +254,23 @@ class Manager:
             raise EntityAlreadyExistsError
 
     @classmethod
+    @timed(MONGODB_OPERATION_DURATION, "create_many")
+    async def create_many(cls, collection: str, bodies: List[dict]) -> Dict[int, dict]:
+        """
+        Inserts the documents with a single unordered `insert_many`.
+        Returns the write errors of the rejected documents by their index in `bodies`.
+        """
+
+        if not bodies:
+            return {}
+        try:
+            await cls.get_db()[collection].insert_many(bodies, ordered=False)
+        except BulkWriteError as e:
+            return {error["index"]: error for error in e.details["writeErrors"]}
+        return {}
+
+    @classmethod
+    @timed(MONGODB_OPERATION_DURATION, "update_or_fail")
     async def update_or_fail(cls, collection: str, object_id: str, update_operator: str, body: dict) -> dict:
         try:
             if (
@@ -105,6 +289,7 @@ class Manager:
             raise EntityAlreadyExistsError
 
     @classmethod
+    @timed(MONGODB_OPERATION_DURATION, "delete_or_fail")
     async def delete_or_fail(cls, collection: str, object_id: str) -> None:
         res = await cls.get_db()[collection].find_one_and_delete({"_id": ObjectId(object_id)})
         if res is None:
@@ -113,45 +298,485 @@ class Manager:
             )
 
     @classmethod
+    @timed(MONGODB_OPERATION_DURATION, "get_or_create")
     async def get_or_create(cls, collection: str, body: dict) -> dict:
+        """
+        Returns the document matching `body`, inserting it first if needed, in a single atomic round trip.
+        The upsert is idempotent, so identical concurrent calls are coalesced like the reads.
+        """
+
+        async def query():
+            try:
+                return await cls.get_db()[collection].find_one_and_update(
+                    body,
+                    {"$setOnInsert": body},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+            except DuplicateKeyError:
+                # A concurrent upsert of the same document won the race, or `body` conflicts with another document.
+                if (res := await cls.get_db()[collection].find_one(body)) is not None:
+                    return res
+                raise EntityAlreadyExistsError
+
+        return await cls.singleflight("get_or_create", collection, body, query)
+
+    @classmethod
+    @timed(MONGODB_OPERATION_DURATION, "get_or_create_many")
+    async def get_or_create_many(cls, collection: str, bodies: List[dict]) -> List[dict]:
+        """
+        Bulk version of `get_or_create`. Returns the documents in the order of `bodies`.
+        """
+
+        if not bodies:
+            return []
         try:
-            return await cls.get_or_fail(collection, body)
-        except EntityDoesNotExistError:
-            return await cls.create_or_fail(collection, body)
+            await cls.get_db()[collection].bulk_write(
+                [UpdateOne(body, {"$setOnInsert": body}, upsert=True) for body in bodies],
+                ordered=False
+            )
+        except BulkWriteError as e:
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+
+        documents = await cls.get_db()[collection].find({"$or": bodies}).to_list(length=None)
+        res = []
+        for body in bodies:
+            match = next((d for d in documents if all(d.get(k) == v for k, v in body.items())), None)
+            if match is None:
+                raise EntityAlreadyExistsError(detail=f"Document with {body} conflicts with another document in the {collection=}.")
+            res.append(match)
+        return res
+
+
+def sort_keys(order_by: str, order_direction: Literal[1, -1]) -> List[Tuple[str, Literal[1, -1]]]:
+    """
+    Returns the sort specification with `_id` as the tie breaker, so every document has a unique position.
+    """
+
+    if order_by == "_id":
+        return [("_id", order_direction)]
+    return [(order_by, order_direction), ("_id", order_direction)]
+
+
+def keyset_filter(sort: List[Tuple[str, Literal[1, -1]]], values: list) -> dict:
+    """
+    Returns the filter matching the documents positioned after `values` in the given sort order.
+    """
+
+    branches = []
+    for i, (field, direction) in enumerate(sort):
+        branch = {f: v for (f, _), v in zip(sort[:i], values[:i])}
+        branch[field] = {"$gt" if direction == ASCENDING else "$lt": values[i]}
+        branches.append(branch)
+    return branches[0] if len(branches) == 1 else {"$or": branches}
+
+
+def page_cursors(documents: list, order_by: str, order_direction: Literal[1, -1]) -> dict:
+    """
+    Returns the `before` and `after` cursors pointing at the first and the last document of a page.
+    """
+
+    if not documents:
+        return {"before": None, "after": None}
+    fields = [field for field, _ in sort_keys(order_by, order_direction)]
+    return {
+        "before": encode_cursor([documents[0][field] for field in fields]),
+        "after": encode_cursor([documents[-1][field] for field in fields])
+    }
+
+
+class IndexSpec(BaseModel):
+    """
+    The full specification of a MongoDB index, see `Migration`.
+    """
+
+    keys: List[Tuple[str, Literal[1, -1, "text"]]]
+    name: Optional[str] = None
+    unique: bool = False
+    sparse: bool = False
+    expire_after_seconds: Optional[int] = None
+    partial_filter_expression: Optional[dict] = None
+    weights: Optional[Dict[str, int]] = None
+
+    @property
+    def index_name(self) -> str:
+        return self.name or "_".join(f"{field}_{direction}" for field, direction in self.keys)
+
+    @property
+    def options(self) -> dict:
+        options = {
+            "unique": self.unique or None,
+            "sparse": self.sparse or None,
+            "expireAfterSeconds": self.expire_after_seconds,
+            "partialFilterExpression": self.partial_filter_expression,
+            "weights": self.weights
+        }
+        return {k: v for k, v in options.items() if v is not None}
+
+    def matches(self, existing: dict) -> bool:
+        # Text fields are stored under the internal `_fts` and `_ftsx` keys and listed in `weights`,
+        # while the other fields of a compound text index keep their place in the key.
+        text = {field for field, direction in self.keys if direction == "text"}
+        keys = [(field, int(direction)) for field, direction in existing["key"].items() if field not in ("_fts", "_ftsx")]
+        if keys != [(field, direction) for field, direction in self.keys if direction != "text"]:
+            return False
+        if text and set(existing.get("weights", {})) != text:
+            return False
+        return all(existing.get(k) == v for k, v in self.options.items() if k != "weights") and \
+            all(existing.get(k) in (None, False) for k in ("unique", "sparse") if k not in self.options)
 
 
 class Migration:
     """
-    Inherit from this class to create unique indexes on the corresponding MongoDB collection.
+    Inherit from this class to declare the indexes of the corresponding MongoDB collection.
+    `commit` diffs the declared indexes against `list_indexes()`, builds the missing ones in parallel
+    and, on request, drops the ones which are no longer declared.
 
     You must create the following class variables:
         collection: ClassVar[str] -> The name of the collection.
-        unique: ClassVarList[Tuple[str, Literal[1, -1]]] -> The list of fields and indexing orders.
+
+    You may create the following class variables:
+        unique: ClassVar[List[Tuple[str, Literal[1, -1]]]] -> Single field unique indexes.
+        indexes: ClassVar[List[Migration.Index | List[Tuple[str, Literal[1, -1, "text"]]]]] -> Full index specs,
+            or bare key lists for plain compound indexes.
 
     Example Use Case:
         class User(Migration):
             collection: ClassVar = "users"
             unique: ClassVar = [("username", 1), ("email", -1)]
+            indexes: ClassVar = [
+                [("is_admin", 1), ("username", 1)],
+                Migration.Index(keys=[("expires_at", 1)], expire_after_seconds=0),
+                Migration.Index(keys=[("bio", "text")], partial_filter_expression={"is_active": True})
+            ]
     """
 
+    Index = IndexSpec
+
     class IndexSchema(BaseModel):
         collection: str
-        unique: List[Tuple[str, Literal[1, -1]]]
+        unique: List[Tuple[str, Literal[1, -1]]] = []
+        indexes: List[Union[IndexSpec, List[Tuple[str, Literal[1, -1, "text"]]]]] = []
+
+        def specs(self) -> List[IndexSpec]:
+            return [IndexSpec(keys=[u], unique=True) for u in self.unique] + [
+                i if isinstance(i, IndexSpec) else IndexSpec(keys=i) for i in self.indexes
+            ]
 
     @classmethod
-    async def commit(cls):
+    def declared(cls) -> Dict[str, List[IndexSpec]]:
+        res = defaultdict(list)
+        for subclass in cls.__subclasses__():
+            if not hasattr(subclass, "collection"):
+                raise ValueError(f"{subclass.__name__} must have a 'collection' attribute.")
+            if not hasattr(subclass, "unique") and not hasattr(subclass, "indexes"):
+                raise ValueError(f"{subclass.__name__} must have a 'unique' or an 'indexes' attribute.")
+
+            schema = cls.IndexSchema(
+                collection=subclass.collection,
+                unique=getattr(subclass, "unique", []),
+                indexes=getattr(subclass, "indexes", [])
+            )
+            res[schema.collection].extend(schema.specs())
+        return res
+
+    @classmethod
+    async def diff(cls, collection: str, specs: List[IndexSpec]) -> Tuple[list, list, list]:
+        """
+        Returns the missing specs, the changed specs and the names of the stale indexes of the collection.
+        """
+
+        existing = {i["name"]: i async for i in Manager.get_db()[collection].list_indexes()}
+        missing = [spec for spec in specs if spec.index_name not in existing]
+        changed = [spec for spec in specs if spec.index_name in existing and not spec.matches(existing[spec.index_name])]
+        declared = {spec.index_name for spec in specs}
+        stale = [name for name in existing if name != "_id_" and name not in declared]
+        return missing, changed, stale
+
+    @classmethod
+    async def build(cls, collection: str, spec: IndexSpec) -> None:
+        started = time.perf_counter()
+        await Manager.get_db()[collection].create_index(spec.keys, name=spec.index_name, **spec.options)
+        log.info(f"Built index {spec.index_name} on the {collection} in {time.perf_counter() - started:.3f}s.")
+
+    @classmethod
+    async def drop(cls, collection: str, name: str) -> None:
+        await Manager.get_db()[collection].drop_index(name)
+        log.info(f"Dropped index {name} on the {collection}.")
+
+    @classmethod
+    async def commit(cls, drop_stale: bool = False, dry_run: bool = False):
         with Manager() as _:
-            for subclass in cls.__subclasses__():
-                if not hasattr(subclass, "collection"):
-                    raise ValueError(f"{subclass.__name__} must have a 'collection' attribute.")
-                if not hasattr(subclass, "unique"):
-                    raise ValueError(f"{subclass.__name__} must have a 'unique' attribute.")
-
-                res = cls.IndexSchema(
-                    collection=subclass.collection,
-                    unique=subclass.unique
-                )
+            drops, builds = [], []
+            for collection, specs in cls.declared().items():
+                missing, changed, stale = await cls.diff(collection, specs)
+                for spec in missing:
+                    log.info(f"Missing index {spec.index_name} on the {collection}.")
+                for spec in changed:
+                    log.warning(f"Index {spec.index_name} on the {collection} does not match its declaration.")
+                for name in stale:
+                    log.warning(f"Index {name} on the {collection} is no longer declared.")
+
+                builds += [(collection, spec) for spec in missing]
+                if drop_stale:
+                    drops += [(collection, name) for name in stale + [spec.index_name for spec in changed]]
+                    builds += [(collection, spec) for spec in changed]
+
+            if dry_run:
+                return
+            await asyncio.gather(*(cls.drop(collection, name) for collection, name in drops))
+            await asyncio.gather(*(cls.build(collection, spec) for collection, spec in builds))
+            log.info(f"Migration finished: {len(builds)} index(es) built, {len(drops)} index(es) dropped.")
+
+
+class MessageBucket(Migration):
+    """
+    Messages are stored in fixed-size per-room buckets instead of an ever growing array on the room.
+
+    Document shape:
+        {
+            "room": ObjectId,
+            "count": int,            -> Number of messages in the bucket, capped at MONGODB_MESSAGES_BUCKET_SIZE.
+            "start": datetime,       -> Timestamp of the oldest message in the bucket.
+            "end": datetime,         -> Timestamp of the newest message in the bucket.
+            "messages": [{"_id": ObjectId, "sender": str, "message": Any, "timestamp": datetime}]
+        }
+    """
+
+    collection: ClassVar = MONGODB_COLLECTION_MESSAGES
+    indexes: ClassVar = [
+        [("room", ASCENDING), ("count", ASCENDING)],
+        [("room", ASCENDING), ("start", DESCENDING), ("_id", DESCENDING)],
+        # Prefixed by the room, so a search only reads the postings of the rooms it covers. Replacing the former
+        # collection-wide text index needs `migrate --drop-stale`, as a collection holds a single text index.
+        Migration.Index(keys=[("room", ASCENDING), ("messages.message", "text")], name="messages_text")
+    ]
+
+
+class Inbox(Migration):
+    """
+    One entry per (user, room), created with the room and rewritten on every message of the room,
+    so listing the rooms of a user is one range read.
+
+    Document shape:
+        {
+            "user": str,             -> Object id of the owner of the entry.
+            "room": ObjectId,
+            "participants": [str],   -> Object ids of the other participants.
+            "last_message": {"_id": ObjectId, "sender": str, "preview": str} | None,
+            "timestamp": datetime,   -> Timestamp of the last message, or of the creation of the room.
+            "unread": int
+        }
+    """
+
+    collection: ClassVar = MONGODB_COLLECTION_INBOX
+    indexes: ClassVar = [
+        Migration.Index(keys=[("user", ASCENDING), ("room", ASCENDING)], unique=True),
+        [("user", ASCENDING), ("timestamp", DESCENDING), ("room", DESCENDING)]
+    ]
+
+
+def new_message(sender: str, message: Any) -> dict:
+    return {
+        "_id": ObjectId(),
+        "sender": sender,
+        "message": message,
+        "timestamp": datetime.now(timezone.utc)
+    }
+
+
+def message_bucket_upsert(room_id: ObjectId, message: dict) -> Tuple[dict, dict]:
+    """
+    Returns the filter and the update which append the message to the open bucket of the room.
+    A new bucket is upserted once the current one is full, so the cost of a write never depends on the room history.
+    """
+
+    return (
+        {"room": room_id, "count": {"$lt": MONGODB_MESSAGES_BUCKET_SIZE}},
+        {
+            "$push": {"messages": message},
+            "$inc": {"count": 1},
+            "$min": {"start": message["timestamp"]},
+            "$max": {"end": message["timestamp"]}
+        }
+    )
+
+
+@timed(MONGODB_OPERATION_DURATION, "add_message_to_room")
+async def add_message_to_room(db: AsyncIOMotorDatabase, room_id: ObjectId, sender: str, message: Any) -> dict:
+    message = new_message(sender, message)
+    await db[MONGODB_COLLECTION_MESSAGES].update_one(*message_bucket_upsert(room_id, message), upsert=True)
+    return message
+
+
+def inbox_upsert(user_id: str, room_id: ObjectId, participants: List[str], message: dict, unread: int) -> UpdateOne:
+    return UpdateOne(
+        {"user": user_id, "room": room_id},
+        {
+            "$set": {
+                "participants": [p for p in participants if p != user_id],
+                "last_message": {
+                    "_id": message["_id"],
+                    "sender": message["sender"],
+                    "preview": str(message["message"])[:MONGODB_INBOX_PREVIEW_LENGTH]
+                }
+            },
+            "$max": {"timestamp": message["timestamp"]},
+            "$inc": {"unread": unread}
+        },
+        upsert=True
+    )
+
 
-                for u in res.unique:
-                    await Manager.get_db()[res.collection].create_index([u], unique=True)
-                log.info(f"Successfully created {res.unique} index on the {res.collection}.")
+@timed(MONGODB_OPERATION_DURATION, "add_room_to_inbox")
+async def add_room_to_inbox(db: AsyncIOMotorDatabase, room_id: ObjectId, participants: List[str]) -> None:
+    """
+    Creates the empty inbox entries of the room, so the room is listed before its first message.
+    Existing entries are left untouched.
+    """
+
+    timestamp = datetime.now(timezone.utc)
+    await db[MONGODB_COLLECTION_INBOX].bulk_write(
+        [
+            UpdateOne(
+                {"user": p, "room": room_id},
+                {
+                    "$setOnInsert": {
+                        "participants": [other for other in participants if other != p],
+                        "last_message": None,
+                        "timestamp": timestamp,
+                        "unread": 0
+                    }
+                },
+                upsert=True
+            )
+            for p in participants
+        ],
+        ordered=False
+    )
+
+
+@timed(MONGODB_OPERATION_DURATION, "add_message_to_inbox")
+async def add_message_to_inbox(
+    db: AsyncIOMotorDatabase,
+    room_id: ObjectId,
+    sender_id: str,
+    participants: List[str],
+    message: dict
+) -> None:
+    await db[MONGODB_COLLECTION_INBOX].bulk_write(
+        [inbox_upsert(p, room_id, participants, message, int(p != sender_id)) for p in participants],
+        ordered=False
+    )
+
+
+@timed(MONGODB_OPERATION_DURATION, "get_inbox")
+async def get_inbox(db: AsyncIOMotorDatabase, user_id: str, limit: int, after: Optional[list] = None) -> list:
+    """
+    Returns up to `limit` inbox entries of the user, most recent first, positioned after the `after` key.
+    """
+
+    sort = [("timestamp", DESCENDING), ("room", DESCENDING)]
+    query = {"user": user_id}
+    if after is not None:
+        query.update(keyset_filter(sort, after))
+    return await db[MONGODB_COLLECTION_INBOX].find(query).sort(sort).limit(limit).to_list(length=limit)
+
+
+@timed(MONGODB_OPERATION_DURATION, "get_room_messages")
+async def get_room_messages(
+    db: AsyncIOMotorDatabase,
+    room_id: ObjectId,
+    limit: int,
+    before: Optional[Tuple[datetime, ObjectId]] = None
+) -> list:
+    """
+    Returns up to `limit` messages of the room, newest first, strictly older than the `before` key.
+    Buckets are walked backwards on the (room, start, _id) index, so every page costs the same.
+    """
+
+    query = {"room": room_id}
+    if before is not None:
+        query["start"] = {"$lte": before[0]}
+
+    page = []
+    buckets = db[MONGODB_COLLECTION_MESSAGES] \
+        .find(query) \
+        .sort([("start", DESCENDING), ("_id", DESCENDING)]) \
+        .batch_size(limit // MONGODB_MESSAGES_BUCKET_SIZE + 2)
+    async for bucket in buckets:
+        if len(page) >= limit and bucket["end"] < page[-1]["timestamp"]:
+            break
+        page.extend(
+            message for message in bucket["messages"]
+            if before is None or (message["timestamp"], message["_id"]) < before
+        )
+        page.sort(key=lambda message: (message["timestamp"], message["_id"]), reverse=True)
+        del page[limit:]
+    return page
+
+
+@timed(MONGODB_OPERATION_DURATION, "search_messages")
+async def search_messages(
+    db: AsyncIOMotorDatabase, room_ids: List[ObjectId], terms: List[str], limit: int, skip: int = 0
+) -> Tuple[list, bool]:
+    """
+    Returns the messages of the given rooms containing any of the terms as whole words, best match first,
+    and whether this is the last page. Terms match like `chat.search.tokenize` splits them, without stemming.
+
+    The `messages_text` index is prefixed by the room, so every room is searched with its own equality query
+    which only reads the postings of that room, whatever the size of the collection. The rooms are searched
+    concurrently, at most MONGODB_SEARCH_MAX_CONCURRENCY at a time, and merged; text scores only depend
+    on the bucket, so they compare across rooms. The latency thus grows with the rooms of the user and
+    the matches in them. In every room only the best MONGODB_SEARCH_MAX_BUCKETS buckets are scanned
+    for the matching messages, the messages outside of them are never returned.
+    """
+
+    pattern = r"\b(?:" + "|".join(re.escape(term) for term in terms) + r")\b"
+    searches = asyncio.Semaphore(MONGODB_SEARCH_MAX_CONCURRENCY)
+
+    async def search_room(room_id: ObjectId) -> list:
+        pipeline = [
+            {"$match": {"room": room_id, "$text": {"$search": " ".join(terms)}}},
+            {"$sort": {"score": {"$meta": "textScore"}}},
+            {"$limit": MONGODB_SEARCH_MAX_BUCKETS},
+            {"$project": {"room": 1, "messages": 1, "score": {"$meta": "textScore"}}},
+            {"$unwind": "$messages"},
+            {"$match": {"messages.message": {"$regex": pattern, "$options": "i"}}},
+            {"$sort": {"score": DESCENDING, "messages.timestamp": DESCENDING}},
+            {"$limit": skip + limit + 1}
+        ]
+        async with searches:
+            return [
+                {"room": res["room"], "score": res["score"], "message": res["messages"]}
+                async for res in db[MONGODB_COLLECTION_MESSAGES].aggregate(pipeline)
+            ]
+
+    res = [match for matches in await asyncio.gather(*(search_room(room_id) for room_id in room_ids)) for match in matches]
+    res.sort(key=lambda match: (match["score"], match["message"]["timestamp"]), reverse=True)
+    return res[skip:skip + limit], len(res) <= skip + limit
+
+
+def encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str, *types: type) -> list:
+    """
+    Decodes a cursor made by `encode_cursor`. When `types` are given, the values must match them one to one,
+    so a forged cursor cannot reach a comparison of mismatched types.
+    """
+
+    try:
+        values = json_util.loads(
+            base64.urlsafe_b64decode(cursor.encode()),
+            json_options=json_util.JSONOptions(tz_aware=False)
+        )
+    except Exception:
+        raise ValueError(f"Invalid cursor {cursor!r}.")
+    if not isinstance(values, list):
+        raise ValueError(f"Invalid cursor {cursor!r}.")
+    if types and (len(values) != len(types) or not all(isinstance(v, t) for v, t in zip(values, types))):
+        raise ValueError(f"Invalid cursor {cursor!r}.")
+    return values
@@ -1,14 +1,43 @@
 from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+import socketio
+import time
 
 from .logging import log
+from .metrics import REDIS_COMMAND_DURATION
 from . import settings
 
 
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        started = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            REDIS_COMMAND_DURATION.observe(time.perf_counter() - started, "PIPELINE")
+
+
+class InstrumentedRedis(Redis):
+    """
+    Records the latency of every command, labelled by command name, and of every pipeline as a whole.
+    """
+
+    async def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            REDIS_COMMAND_DURATION.observe(time.perf_counter() - started, str(args[0]).upper())
+
+    def pipeline(self, transaction: bool = True, shard_hint: str = None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
 class Manager:
     _db: Redis = None
 
     async def __aenter__(self):
-        Manager._db = Redis.from_url(
+        Manager._db = InstrumentedRedis.from_url(
             settings.REDIS_URL,
             decode_responses=True
         )
@@ -17,7 +46,6 @@ class Manager:
 
     async def __aexit__(self, exc_type, exc_value, traceback):
         if Manager._db is not None:
-            await Manager._db.flushdb()
             await Manager._db.close()
             Manager._db = None
         log.info("Disconnected from Redis.")
@@ -25,3 +53,12 @@ class Manager:
     @classmethod
     def get_db(cls) -> Redis:
         return cls._db
+
+    @classmethod
+    def get_client_manager(cls, channel: str) -> socketio.AsyncRedisManager:
+        """
+        Returns a Socket.IO client manager which relays emits, room membership and disconnects
+        through Redis pub/sub, so every worker connected to the same Redis shares the same rooms.
+        """
+
+        return socketio.AsyncRedisManager(settings.REDIS_URL, channel=channel)
@@ -1,5 +1,7 @@
+from typing import Literal, Optional
 from pathlib import Path
 import logging
+import os
 
 from pydantic_settings import BaseSettings
 from pydantic import ConfigDict
@@ -14,6 +16,19 @@ class Env(BaseSettings):
     MONGODB_URL: str = ...
     REDIS_URL: str = ...
     JWT_SECRET_KEY: str = ...
+    SOCKETIO_REDIS_MANAGER: bool = False
+    SOCKETIO_RATE_LIMIT: bool = True
+    SOCKETIO_WEBSOCKET_ONLY: bool = False
+    UVICORN_HOST: str = "127.0.0.1"
+    UVICORN_PORT: int = 5000
+    SEARCH_BACKEND: Literal["mongodb", "memory"] = "mongodb"
+    MONGODB_MAX_POOL_SIZE: int = 100
+    MONGODB_MIN_POOL_SIZE: int = 10
+    MONGODB_WAIT_QUEUE_TIMEOUT_MS: Optional[int] = 10_000
+    MONGODB_READ_PREFERENCE: Literal["primary", "primaryPreferred", "secondary", "secondaryPreferred", "nearest"] = "primary"
+    MONGODB_READ_CONCERN: Optional[Literal["local", "available", "majority", "linearizable", "snapshot"]] = None
+    MONGODB_COMPRESSORS: str = ""
+    HASH_IMPORT_MAX_CONCURRENCY: int = 2
 
     model_config = ConfigDict(
         env_file=ENV_FILE,
@@ -27,36 +42,124 @@ env = Env()
 
 API_PREFIX = "api"
 LOGIN_URL = f"/{API_PREFIX}/auth/"
+# Served by any worker, with the values of every worker labelled by its pid: this worker's current ones,
+# and the others' as published to Redis every METRICS_PUBLISH_INTERVAL seconds.
+METRICS_URL = "/metrics"
+METRICS_PUBLISH_INTERVAL = 5
 ROUTER_DIRS = [
     "user",
     "auth",
+    "admin",
+    "chat",
+]
+MIGRATION_MODULES = [
+    "core.mongodb",
+    "user.migrations",
 ]
 
 FAST_API_TITLE = "Chat App"
 FAST_API_VERSION = "0.0.0"
 FAST_API_DEBUG = False
 
-UVICORN_NAME = "manage:app"
-UVICORN_HOST = "127.0.0.1"
-UVICORN_PORT = 5000
+UVICORN_NAME = "manage:create_app"
+UVICORN_FACTORY = True
+UVICORN_HOST = env.UVICORN_HOST
+UVICORN_PORT = env.UVICORN_PORT
 UVICORN_RELOAD = True
+UVICORN_WORKERS = os.cpu_count() or 1
+UVICORN_LOOP = "auto"
+UVICORN_HTTP = "auto"
+UVICORN_TIMEOUT_GRACEFUL_SHUTDOWN = 30
 
 MONGODB_URL = env.MONGODB_URL
-MONGODB_MAX_POOL_SIZE = 1
-MONGODB_MIN_POOL_SIZE = 1
+MONGODB_MAX_POOL_SIZE = env.MONGODB_MAX_POOL_SIZE
+MONGODB_MIN_POOL_SIZE = env.MONGODB_MIN_POOL_SIZE
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = env.MONGODB_WAIT_QUEUE_TIMEOUT_MS
+MONGODB_READ_PREFERENCE = env.MONGODB_READ_PREFERENCE
+MONGODB_READ_CONCERN = env.MONGODB_READ_CONCERN
+MONGODB_COMPRESSORS = [c.strip() for c in env.MONGODB_COMPRESSORS.split(",") if c.strip()]
 MONGODB_DATABASE_NAME = "chat-app"
 MONGODB_COLLECTION_USERS = "users"
+MONGODB_COLLECTION_ROOMS = "rooms"
+MONGODB_COLLECTION_MESSAGES = "messages"
+MONGODB_COLLECTION_INBOX = "inbox"
+MONGODB_INBOX_PREVIEW_LENGTH = 100
+MONGODB_IMPORT_BATCH_SIZE = 1000
+MONGODB_EXPORT_BATCH_SIZE = 1000
+MONGODB_SEARCH_MAX_BUCKETS = 200
+MONGODB_SEARCH_MAX_CONCURRENCY = 16
+MONGODB_MESSAGES_BUCKET_SIZE = 100
+MONGODB_WRITE_BEHIND = False
+MONGODB_WRITE_BEHIND_BATCH_SIZE = 500
+MONGODB_WRITE_BEHIND_WINDOW = 0.05
+MONGODB_WRITE_BEHIND_MAX_PENDING = 10_000
+# Concurrent identical reads of these query shapes (the sorted fields of the filter) share one in-flight query.
+MONGODB_SINGLEFLIGHT = {
+    MONGODB_COLLECTION_USERS: [("username",), ("email", "username")],
+    MONGODB_COLLECTION_ROOMS: [("_id", "participants", "type")],
+}
 
 REDIS_URL = env.REDIS_URL
+REDIS_PRESENCE_PREFIX = "presence"
+REDIS_USER_CACHE_PREFIX = "cache:user"
+REDIS_USER_CACHE_TTL = 5 * 60
+REDIS_USER_CACHE_FIELDS = ("_id", "username", "email", "is_admin")
+REDIS_ROOM_MEMBERS_PREFIX = "cache:room"
+REDIS_ROOM_MEMBERS_TTL = 60 * 60
+REDIS_USER_ROOMS_PREFIX = "cache:user-rooms"
+REDIS_USER_ROOMS_TTL = 60 * 60
+REDIS_DELIVERY_PREFIX = "delivery"
+REDIS_DELIVERY_MAX_LENGTH = 10_000
+REDIS_DELIVERY_TTL = 30 * 24 * 60 * 60
+REDIS_RATE_LIMIT_PREFIX = "ratelimit"
+REDIS_METRICS_PREFIX = "metrics"
 
 SOCKETIO_PING_INTERVAL = 25
 SOCKETIO_PING_TIMEOUT = 5
 SOCKETIO_DEBUG = False
+SOCKETIO_ROOM_HISTORY_PAGE_SIZE = 50
+SOCKETIO_PREVIOUS_ROOMS_PAGE_SIZE = 20
+SOCKETIO_SEARCH_PAGE_SIZE = 20
+SOCKETIO_REPLAY_BATCH_SIZE = 100
+SOCKETIO_REPLAY_MAX_FRAMES = 10
+SOCKETIO_REPLAY_MAX_CONCURRENCY = 32
+SOCKETIO_EPHEMERAL_WINDOW = 1
+SOCKETIO_EPHEMERAL_TICK = 0.25
+SOCKETIO_EPHEMERAL_TYPES = ("typing", "presence")
+SOCKETIO_REDIS_MANAGER = env.SOCKETIO_REDIS_MANAGER
+# Long-polling needs every request of a session to reach the same worker, so without sticky sessions
+# in front of several workers only the websocket transport can work.
+SOCKETIO_WEBSOCKET_ONLY = env.SOCKETIO_WEBSOCKET_ONLY
+SOCKETIO_TRANSPORTS = ["websocket"] if SOCKETIO_WEBSOCKET_ONLY else ["polling", "websocket"]
+SOCKETIO_REDIS_CHANNEL = "socketio"
+SOCKETIO_SHUTDOWN_TIMEOUT = 10
+SOCKETIO_RATE_LIMIT = env.SOCKETIO_RATE_LIMIT
+# Token buckets of every user, shared by the cluster: event -> (tokens refilled per second, burst).
+SOCKETIO_RATE_LIMITS = {
+    "private_room": (1, 5),
+    "private_message": (10, 20),
+    "pending_messages": (1, 3),
+    "previous_rooms": (5, 10),
+    "room_history": (5, 10),
+    "search_messages": (2, 5),
+}
+SOCKETIO_ADMISSION_MAX_CONCURRENCY = 64
+SOCKETIO_ADMISSION_MAX_QUEUE = 1000
+SOCKETIO_ADMISSION_TIMEOUT = 5
 SOCKETIO_CORS_ALLOWED_ORIGINS = [
     'http://127.0.0.1:5500',
     'https://admin.socket.io'
 ]
 
+HASH_MAX_WORKERS = 4
+# Hashing threads the import endpoint may hold on the shared pool, the rest stay free for the logins.
+HASH_IMPORT_MAX_CONCURRENCY = env.HASH_IMPORT_MAX_CONCURRENCY
+# `manage.py importusers` serves no logins, so it hashes on a pool of its own with a thread per CPU.
+HASH_IMPORT_CLI_WORKERS = os.cpu_count() or 1
+
+# "mongodb" uses the text index on the messages; "memory" keeps an in-process inverted index for local development.
+SEARCH_BACKEND = env.SEARCH_BACKEND
+
 JWT_TOKEN_TYPE = "bearer"
 JWT_ALGORITHM = "HS256"
 JWT_SECRET_KEY = env.JWT_SECRET_KEY
@@ -1,22 +1,43 @@
 #!/usr/bin/env python
 
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, suppress
 from importlib import import_module
+from pathlib import Path
+import subprocess
 import asyncio
+import json
+import sys
+import os
 
-from fastapi import FastAPI, Request, responses
-import uvicorn
 import click
 
-from core import settings, mongodb, redis, exceptions
+from core import settings
 
 
-def create_app() -> FastAPI:
+def create_app():
+    """
+    Builds the application. FastAPI, the routers and the chat server are only imported here,
+    so the management commands which do not serve requests never pay for them.
+    """
+
+    from fastapi import FastAPI, Request, responses
+
+    from core import mongodb, redis, exceptions, metrics
+    from chat import app as chat
+
     @asynccontextmanager
     async def lifespan(_: FastAPI):
         with mongodb.Manager() as _:
             async with redis.Manager() as _:
-                yield
+                publisher = asyncio.create_task(metrics.publish(redis.Manager.get_db()))
+                try:
+                    async with chat.lifespan():
+                        yield
+                finally:
+                    publisher.cancel()
+                    with suppress(asyncio.CancelledError):
+                        await publisher
+                    await redis.Manager.get_db().delete(metrics.worker_key())
 
     app = FastAPI(
         lifespan=lifespan,
@@ -52,13 +73,22 @@ def create_app() -> FastAPI:
     #     allow_methods=["*"],
     #     allow_headers=["*"],
     # )
-    from chat.app import server
-    app.mount("/", app=server)
+    @app.get(settings.METRICS_URL, include_in_schema=False)
+    async def metrics_endpoint():
+        others = await metrics.collect(redis.Manager.get_db())
+        return responses.PlainTextResponse(metrics.render(others), media_type="text/plain; version=0.0.4")
+
+    app.mount("/", app=chat.server)
 
     return app
 
 
-app = create_app()
+def __getattr__(name: str):
+    # Keeps `manage:app` importable without building the application on every import of this module.
+    if name == "app":
+        globals()["app"] = app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 @click.group()
@@ -67,29 +97,181 @@ def cli():
 
 
 @click.command("runserver")
-def run_server():
+@click.option("--production", is_flag=True, help="Disable the reloader and serve with multiple workers.")
+@click.option("--workers", type=int, default=settings.UVICORN_WORKERS, show_default=True, help="Worker processes in production.")
+@click.option("--host", default=settings.UVICORN_HOST, show_default=True, help="Bind address.")
+@click.option("--port", type=int, default=settings.UVICORN_PORT, show_default=True, help="Bind port.")
+@click.option("--loop", type=click.Choice(["auto", "asyncio", "uvloop"]), default=settings.UVICORN_LOOP, show_default=True)
+@click.option("--http", type=click.Choice(["auto", "h11", "httptools"]), default=settings.UVICORN_HTTP, show_default=True)
+@click.option("--sticky-sessions", is_flag=True, help="A front end routes every Socket.IO session to a single worker.")
+def run_server(production: bool, workers: int, host: str, port: int, loop: str, http: str, sticky_sessions: bool):
+    if production and workers > 1 and not settings.SOCKETIO_REDIS_MANAGER:
+        raise click.UsageError("Running more than one worker requires SOCKETIO_REDIS_MANAGER to be enabled.")
+    if production and workers > 1 and not sticky_sessions:
+        # The workers share the listening socket, so the polling requests of a session would land on any of them.
+        click.echo("Multiple workers without sticky sessions: Socket.IO is restricted to the websocket transport.")
+        os.environ["SOCKETIO_WEBSOCKET_ONLY"] = "true"
+
+    import uvicorn
+
     uvicorn.run(
         settings.UVICORN_NAME,
-        host=settings.UVICORN_HOST,
-        port=settings.UVICORN_PORT,
-        reload=settings.UVICORN_RELOAD
+        factory=settings.UVICORN_FACTORY,
+        host=host,
+        port=port,
+        reload=settings.UVICORN_RELOAD and not production,
+        workers=workers if production else None,
+        loop=loop,
+        http=http,
+        timeout_graceful_shutdown=settings.UVICORN_TIMEOUT_GRACEFUL_SHUTDOWN
     )
 
 
 @click.command()
-def migrate():
-    asyncio.run(mongodb.Migration.commit())
+@click.option("--drop-stale", is_flag=True, help="Drop indexes which are no longer declared, and rebuild changed ones.")
+@click.option("--dry-run", is_flag=True, help="Only report the difference between the declared and the existing indexes.")
+def migrate(drop_stale: bool, dry_run: bool):
+    from core import mongodb
+
+    # Migrations are collected from the subclasses of Migration, so their modules must be imported first.
+    for module in settings.MIGRATION_MODULES:
+        import_module(module)
+    asyncio.run(mongodb.Migration.commit(drop_stale=drop_stale, dry_run=dry_run))
 
 
 # RUN THIS COMMAND AFTER MIGRATING TO PREVENT DuplicateKeyError.
 @click.command("createsuperuser")
 def create_super_user():
+    from core import mongodb
+
     asyncio.run(mongodb.Manager.create_super_user())
 
 
+@click.command("importusers")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False, path_type=Path))
+def import_users(path: Path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    from core import mongodb
+    from user import bulk
+
+    async def run():
+        with mongodb.Manager() as _, ThreadPoolExecutor(settings.HASH_IMPORT_CLI_WORKERS, thread_name_prefix="hash") as pool:
+            async for res in bulk.import_users(bulk.file_chunks(path), pool):
+                click.echo(json.dumps(res))
+
+    asyncio.run(run())
+
+
+@click.command("export")
+@click.argument("name", type=click.Choice(["users", "rooms", "messages"]))
+@click.argument("path", type=click.Path(dir_okay=False, writable=True, path_type=Path))
+@click.option("--gzip", "compress", is_flag=True, help="Gzip the export.")
+def export(name: str, path: Path, compress: bool):
+    from core import mongodb
+    from admin.utils import export_to_file
+
+    async def run():
+        with mongodb.Manager() as _:
+            written = await export_to_file(name, path, compress)
+            click.echo(f"Exported the {name} to {path} ({written} bytes).")
+
+    asyncio.run(run())
+
+
+@click.group()
+def bench():
+    pass
+
+
+@bench.command("chat")
+@click.option("--clients", type=int, default=100, show_default=True, help="Simulated clients, paired in private rooms.")
+@click.option("--messages", type=int, default=100, show_default=True, help="Messages sent by each sender.")
+@click.option("--url", default=None, help="Benchmark a running server instead of an in-process one.")
+@click.option("--standins/--no-standins", default=True, show_default=True, help="Use in-process MongoDB and Redis stand-ins.")
+@click.option("--rate-limit/--no-rate-limit", default=False, show_default=True, help="Apply the per-user rate limits in-process.")
+@click.option("--output", type=click.Path(dir_okay=False, writable=True, path_type=Path), default=None, help="Write the report to a file.")
+def bench_chat(clients: int, messages: int, url: str, standins: bool, rate_limit: bool, output: Path):
+    from bench import chat
+
+    report = json.dumps(asyncio.run(chat.run(create_app, clients, messages, url, standins, rate_limit)), indent=4)
+    if output is not None:
+        output.write_text(report)
+    click.echo(report)
+
+
+@bench.command("rest")
+@click.option("--iterations", type=int, default=200, show_default=True, help="Requests per endpoint and runs per breakdown stage.")
+@click.option("--users", type=int, default=1000, show_default=True, help="Users seeded before the run.")
+@click.option("--baseline", type=click.Path(dir_okay=False, path_type=Path), default=None, help="Baseline file to compare against.")
+@click.option("--update-baseline", is_flag=True, help="Overwrite the baseline with this run.")
+@click.option("--tolerance", type=float, default=0.2, show_default=True, help="Allowed slowdown before a metric is reported.")
+def bench_rest(iterations: int, users: int, baseline: Path, update_baseline: bool, tolerance: float):
+    from bench import rest
+
+    report = rest.run_and_compare(create_app, iterations, users, baseline or rest.BASELINE, update_baseline, tolerance)
+    click.echo(json.dumps(report, indent=4))
+    if report.get("regressions"):
+        raise click.ClickException(f"Regressions against the baseline: {', '.join(report['regressions'])}.")
+
+
+IMPORTTIME_TARGETS = {
+    "cli": "import manage",
+    "app": "import manage; manage.create_app()",
+    "migrate": "import importlib, manage; [importlib.import_module(m) for m in manage.settings.MIGRATION_MODULES]",
+}
+
+
+def parse_importtime(output: str) -> list:
+    """
+    Parses the `-X importtime` report into (module, self, cumulative, depth) rows, with the times in microseconds.
+    """
+
+    rows = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), int(own), int(cumulative), depth))
+    return rows
+
+
+@click.command("importtime")
+@click.option("--target", type=click.Choice(list(IMPORTTIME_TARGETS)), default="app", show_default=True, help="What to import.")
+@click.option("--top", type=int, default=15, show_default=True, help="Modules listed in each section.")
+def import_time(target: str, top: int):
+    """Profiles the imports of the target with `python -X importtime` and reports where the time goes."""
+
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", IMPORTTIME_TARGETS[target]],
+        cwd=Path(__file__).resolve().parent,
+        capture_output=True,
+        text=True
+    )
+    if process.returncode != 0:
+        raise click.ClickException(process.stderr.strip().splitlines()[-1] if process.stderr.strip() else "The import failed.")
+
+    rows = parse_importtime(process.stderr)
+    packages = [row for row in rows if row[3] == 0]
+    click.echo(f"Total: {sum(row[2] for row in packages) / 1000:.1f}ms over {len(rows)} modules.")
+
+    click.echo("\nTop-level imports by cumulative time:")
+    for name, _, cumulative, _ in sorted(packages, key=lambda row: row[2], reverse=True)[:top]:
+        click.echo(f"{cumulative / 1000:10.1f}ms  {name}")
+
+    click.echo("\nModules by self time:")
+    for name, own, _, _ in sorted(rows, key=lambda row: row[1], reverse=True)[:top]:
+        click.echo(f"{own / 1000:10.1f}ms  {name}")
+
+
 cli.add_command(run_server)
 cli.add_command(migrate)
 cli.add_command(create_super_user)
+cli.add_command(import_users)
+cli.add_command(export)
+cli.add_command(bench)
+cli.add_command(import_time)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,12 @@
+import os
+import sys
+
+# The settings are read at import time, and the tests run against the in-process stand-ins.
+os.environ.setdefault("MONGODB_URL", "mongodb://localhost:27017")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+os.environ.setdefault("JWT_SECRET_KEY", "test-secret-key")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench import standins  # noqa: E402
+
+standins.install()
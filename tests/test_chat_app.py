@@ -0,0 +1,7 @@
+from chat import app
+
+
+def test_event_handlers_stay_callable():
+    for name in ("connect", "disconnect", "private_room", "private_message", "room_history"):
+        assert callable(getattr(app, name))
+        assert name in app.sio.handlers["/"]
@@ -0,0 +1,79 @@
+import asyncio
+
+import socketio
+
+from bench.utils import Server
+from core import redis
+from core.mongodb import Manager
+from core.settings import MONGODB_COLLECTION_USERS
+from chat import rooms
+from auth.utils import create_access_token
+from manage import create_app
+
+
+async def connect(url: str, username: str) -> socketio.AsyncClient:
+    client = socketio.AsyncClient(reconnection=False)
+    token = create_access_token({"username": username, "email": f"{username}@example.com"})
+    await client.connect(url, headers={"Authorization": f"Bearer {token}"}, transports=["websocket"])
+    return client
+
+
+async def reconnect_and_receive() -> list:
+    async with Server(create_app) as server:
+        alice, bobby = await connect(server.url, "alice"), await connect(server.url, "bobby")
+        room = await alice.call("private_room", {"receiver": "bobby"})
+        await alice.call("private_message", {"room": room, "message": "m0"})
+        await bobby.disconnect()
+
+        received = []
+        bobby = await connect(server.url, "bobby")
+        bobby.on("private_message", received.append)
+        await alice.call("private_message", {"room": room, "message": "m1"})
+        await asyncio.sleep(0.5)
+
+        await asyncio.gather(alice.disconnect(), bobby.disconnect())
+    return received
+
+
+def test_reconnected_user_receives_live_messages():
+    assert "m1" in asyncio.run(reconnect_and_receive())
+
+
+async def reconnect_with_cached_rooms() -> tuple:
+    async with Server(create_app) as server:
+        carol, dave = await connect(server.url, "carol"), await connect(server.url, "dave")
+        await dave.disconnect()
+        # Dave's room set is cached by now, the new room must be added to it rather than hidden.
+        room = await carol.call("private_room", {"receiver": "dave"})
+
+        received = []
+        dave = await connect(server.url, "dave")
+        dave.on("private_message", received.append)
+        await carol.call("private_message", {"room": room, "message": "hello"})
+        await asyncio.sleep(0.5)
+
+        user = await Manager.get_db()[MONGODB_COLLECTION_USERS].find_one({"username": "dave"})
+        cached = await redis.Manager.get_db().smembers(rooms.user_rooms_key(str(user["_id"])))
+        await asyncio.gather(carol.disconnect(), dave.disconnect())
+    return received, cached, room
+
+
+def test_room_created_after_the_rooms_were_cached_is_rejoined():
+    received, cached, room = asyncio.run(reconnect_with_cached_rooms())
+    assert received == ["hello"]
+    assert room in cached
+
+
+async def list_rooms_before_the_first_message() -> tuple:
+    async with Server(create_app) as server:
+        erin, frank = await connect(server.url, "erin"), await connect(server.url, "frank")
+        room = await erin.call("private_room", {"receiver": "frank"})
+        listed = await asyncio.gather(erin.call("previous_rooms", {}), frank.call("previous_rooms", {}))
+        await asyncio.gather(erin.disconnect(), frank.disconnect())
+    return room, listed
+
+
+def test_new_room_is_listed_before_its_first_message():
+    room, listed = asyncio.run(list_rooms_before_the_first_message())
+    for page in listed:
+        assert [(entry["room"], entry["last_message"], entry["unread"]) for entry in page["rooms"]] == [(room, None, 0)]
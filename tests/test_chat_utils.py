@@ -0,0 +1,9 @@
+from datetime import datetime, timezone
+
+from chat.utils import serialize_timestamp
+
+
+def test_timestamps_read_back_naive_render_like_new_ones():
+    created = datetime(2024, 1, 2, 3, 4, 5, 6000, tzinfo=timezone.utc)
+    assert serialize_timestamp(created.replace(tzinfo=None)) == serialize_timestamp(created)
+    assert serialize_timestamp(created).endswith("+00:00")
@@ -0,0 +1,38 @@
+from datetime import datetime
+
+import pytest
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+
+from core.mongodb import keyset_filter, encode_cursor, decode_cursor
+
+
+def test_keyset_filter_on_a_single_key():
+    assert keyset_filter([("_id", ASCENDING)], [1]) == {"_id": {"$gt": 1}}
+    assert keyset_filter([("_id", DESCENDING)], [1]) == {"_id": {"$lt": 1}}
+
+
+def test_keyset_filter_breaks_ties_on_the_following_keys():
+    sort = [("timestamp", DESCENDING), ("room", DESCENDING), ("_id", ASCENDING)]
+    assert keyset_filter(sort, ["t", "r", "i"]) == {"$or": [
+        {"timestamp": {"$lt": "t"}},
+        {"timestamp": "t", "room": {"$lt": "r"}},
+        {"timestamp": "t", "room": "r", "_id": {"$gt": "i"}}
+    ]}
+
+
+def test_typed_cursor_round_trip():
+    values = [datetime(2024, 1, 2, 3, 4, 5, 6000), ObjectId()]
+    assert decode_cursor(encode_cursor(values), datetime, ObjectId) == values
+
+
+@pytest.mark.parametrize("cursor", [
+    encode_cursor([ObjectId(), datetime(2024, 1, 1)]),
+    encode_cursor([datetime(2024, 1, 1)]),
+    encode_cursor([datetime(2024, 1, 1), ObjectId(), 1]),
+    encode_cursor({"timestamp": 1}),
+    "not a cursor"
+])
+def test_decode_cursor_rejects_forged_cursors(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, datetime, ObjectId)
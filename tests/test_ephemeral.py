@@ -0,0 +1,34 @@
+import asyncio
+
+from chat.ephemeral import Coalescer
+
+
+class FakeServer:
+    def __init__(self):
+        self.frames = []
+
+    async def emit(self, event, data, room):
+        self.frames.append(data)
+
+
+def test_throttled_update_is_sent_once_the_window_passes():
+    async def run():
+        sio = FakeServer()
+        coalescer = Coalescer(sio, window=0.1, tick=0.01)
+        assert coalescer.push("sid", "room", {"type": "typing", "state": True})
+        assert not coalescer.push("sid", "room", {"type": "typing", "state": False})
+        await coalescer.flush()
+        await asyncio.sleep(0.15)
+        await coalescer.flush()
+        return sio.frames
+
+    frames = asyncio.run(run())
+    assert [frame["events"][0]["state"] for frame in frames] == [True, False]
+
+
+def test_forget_drops_the_state_of_the_sid():
+    coalescer = Coalescer(FakeServer(), window=1)
+    coalescer.push("sid", "room", {"type": "typing"})
+    coalescer.push("sid", "room", {"type": "typing"})
+    coalescer.forget("sid")
+    assert not coalescer.pending["room"] and "sid" not in coalescer.held and "sid" not in coalescer.last
@@ -0,0 +1,26 @@
+import asyncio
+import json
+import os
+
+import httpx
+
+from bench.utils import Server
+from core import metrics, redis
+from core.settings import METRICS_URL
+from manage import create_app
+
+
+async def scrape_with_another_worker() -> str:
+    async with Server(create_app) as server:
+        other = {"chat_socketio_connected_sockets": ['chat_socketio_connected_sockets{worker="1"} 3']}
+        await redis.Manager.get_db().set(metrics.worker_key(1), json.dumps(other))
+        async with httpx.AsyncClient(base_url=server.url) as client:
+            response = await client.get(METRICS_URL)
+    return response.text
+
+
+def test_scrape_reports_every_worker_under_one_family():
+    lines = asyncio.run(scrape_with_another_worker()).splitlines()
+    assert lines.count("# TYPE chat_socketio_connected_sockets gauge") == 1
+    assert f'chat_socketio_connected_sockets{{worker="{os.getpid()}"}} 0' in lines
+    assert 'chat_socketio_connected_sockets{worker="1"} 3' in lines
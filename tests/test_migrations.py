@@ -0,0 +1,17 @@
+from core.mongodb import IndexSpec
+
+
+def test_plain_index_matches_on_keys_and_options():
+    spec = IndexSpec(keys=[("username", 1)], unique=True)
+    assert spec.matches({"key": {"username": 1}, "unique": True})
+    assert not spec.matches({"key": {"username": -1}, "unique": True})
+    assert not spec.matches({"key": {"username": 1}})
+    assert not IndexSpec(keys=[("username", 1)]).matches({"key": {"username": 1}, "unique": True})
+
+
+def test_compound_text_index_matches_on_its_prefix_and_text_fields():
+    spec = IndexSpec(keys=[("room", 1), ("messages.message", "text")], name="messages_text")
+    existing = {"key": {"room": 1, "_fts": "text", "_ftsx": 1}, "weights": {"messages.message": 1}}
+    assert spec.matches(existing)
+    assert not spec.matches({"key": {"_fts": "text", "_ftsx": 1}, "weights": {"messages.message": 1}})
+    assert not spec.matches({**existing, "weights": {"messages.sender": 1}})
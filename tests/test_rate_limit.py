@@ -0,0 +1,33 @@
+import asyncio
+
+from core import redis
+from chat import limits
+
+
+async def drain_bucket(event: str, user_id: str, calls: int) -> list:
+    async with redis.Manager() as _:
+        return [await limits.acquire(event, user_id) for _ in range(calls)]
+
+
+def test_bucket_allows_the_burst_then_refuses_until_refilled():
+    # private_room refills 1 token per second, with a burst of 5.
+    results = asyncio.run(drain_bucket("private_room", "burst-user", 6))
+    assert results[:5] == [(True, 0)] * 5
+    allowed, retry_after = results[5]
+    assert not allowed and 0 < retry_after <= 1
+
+
+def test_buckets_are_per_user_and_event():
+    async def run():
+        async with redis.Manager() as _:
+            for _ in range(5):
+                await limits.acquire("private_room", "busy-user")
+            return [
+                await limits.acquire("private_room", "busy-user"),
+                await limits.acquire("previous_rooms", "busy-user"),
+                await limits.acquire("private_room", "idle-user")
+            ]
+
+    (exhausted, _), other_event, other_user = asyncio.run(run())
+    assert not exhausted
+    assert other_event == other_user == (True, 0)
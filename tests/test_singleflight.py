@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+from core.mongodb import Manager
+from core.settings import MONGODB_COLLECTION_USERS
+
+
+class Query:
+    """
+    A query held in flight until released, counting its calls.
+    """
+
+    def __init__(self, result=None, error: Exception = None):
+        self.result, self.error = result, error
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        await self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def singleflight(query: Query, body: dict = None) -> asyncio.Task:
+    body = {"username": "alice"} if body is None else body
+    return asyncio.ensure_future(Manager.singleflight("find_one", MONGODB_COLLECTION_USERS, body, query))
+
+
+def test_identical_queries_in_flight_are_coalesced():
+    async def run():
+        query = Query({"username": "alice", "rooms": []})
+        callers = [singleflight(query) for _ in range(3)]
+        await asyncio.sleep(0)
+        query.release.set()
+        return query, await asyncio.gather(*callers)
+
+    query, results = asyncio.run(run())
+    assert query.calls == 1
+    assert all(res == {"username": "alice", "rooms": []} for res in results)
+    assert results[0] is not results[1] and results[0]["rooms"] is not results[1]["rooms"]
+    assert not Manager._inflight
+
+
+def test_uncoalesced_shapes_query_every_time():
+    async def run():
+        query = Query()
+        callers = [singleflight(query, {"is_admin": True}) for _ in range(2)]
+        await asyncio.sleep(0)
+        query.release.set()
+        await asyncio.gather(*callers)
+        return query
+
+    assert asyncio.run(run()).calls == 2
+
+
+def test_errors_are_shared_and_the_query_is_forgotten():
+    async def run():
+        query = Query(error=RuntimeError("down"))
+        callers = [singleflight(query) for _ in range(2)]
+        await asyncio.sleep(0)
+        query.release.set()
+        return query, await asyncio.gather(*callers, return_exceptions=True)
+
+    query, results = asyncio.run(run())
+    assert query.calls == 1
+    assert all(isinstance(res, RuntimeError) for res in results)
+    assert not Manager._inflight
+
+
+def test_cancelled_caller_does_not_cancel_the_shared_query():
+    async def run():
+        query = Query({"username": "alice"})
+        first, second = singleflight(query), singleflight(query)
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        query.release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return query, await second
+
+    query, result = asyncio.run(run())
+    assert query.calls == 1
+    assert result == {"username": "alice"}
+    assert not Manager._inflight
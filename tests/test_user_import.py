@@ -0,0 +1,46 @@
+import asyncio
+import json
+
+import httpx
+
+from bench.utils import Server
+from core.hash import hash_password
+from core.mongodb import Manager, Migration
+from core.settings import API_PREFIX, MONGODB_COLLECTION_USERS
+from auth.utils import create_access_token
+from manage import create_app
+import user.migrations  # noqa: F401
+
+
+ADMIN = {"username": "import_admin", "email": "import_admin@example.com"}
+
+
+async def chunked(body: bytes, size: int = 7):
+    # Small chunks split the lines, as a chunked upload over a real connection does.
+    for i in range(0, len(body), size):
+        yield body[i:i + size]
+
+
+async def post_import(body: bytes) -> list:
+    async with Server(create_app) as server:
+        for spec in Migration.declared()[MONGODB_COLLECTION_USERS]:
+            await Migration.build(MONGODB_COLLECTION_USERS, spec)
+        await Manager.get_db()[MONGODB_COLLECTION_USERS].insert_one({**ADMIN, "password": hash_password("x"), "is_admin": True})
+        headers = {"Authorization": f"Bearer {create_access_token(dict(ADMIN))}"}
+        async with httpx.AsyncClient(base_url=server.url, timeout=60) as client:
+            res = await client.post(f"/{API_PREFIX}/user/import/", content=chunked(body), headers=headers)
+            res.raise_for_status()
+            count = await Manager.get_db()[MONGODB_COLLECTION_USERS].count_documents({"username": {"$regex": "^imported_"}})
+    return [json.loads(line) for line in res.text.splitlines()], count
+
+
+def test_import_users_over_a_real_server():
+    lines = [{"username": f"imported_{i}", "email": f"imported_{i}@example.com", "password": "password123"} for i in range(10)]
+    lines.append(lines[0])
+    body = "\n".join(json.dumps(line) for line in lines) + "\n{not json}\n"
+
+    results, count = asyncio.run(post_import(body.encode()))
+
+    statuses = [res["status"] for res in sorted(results, key=lambda res: res["line"])]
+    assert statuses == ["created"] * 10 + ["duplicate", "invalid"]
+    assert count == 10
@@ -0,0 +1,53 @@
+import asyncio
+
+from pymongo.errors import BulkWriteError
+import bson
+
+from core import mongodb
+from core.mongodb import new_message
+from chat.writer import MessageWriter
+
+
+class FakeServer:
+    def __init__(self):
+        self.emitted = []
+
+    async def emit(self, event, data, to):
+        self.emitted.append((event, to, data))
+
+
+class FakeCollection:
+    def __init__(self, error=None):
+        self.error = error
+
+    async def bulk_write(self, requests, ordered=True):
+        if self.error is not None:
+            raise self.error
+
+
+def batch(size: int) -> list:
+    room_id = bson.ObjectId()
+    return [("sid", room_id, "a", ["a", "b"], new_message("alice", f"m{i}")) for i in range(size)]
+
+
+def flush(monkeypatch, db: dict, messages: list) -> list:
+    sio = FakeServer()
+    monkeypatch.setattr(mongodb.Manager, "get_db", classmethod(lambda cls: db))
+    asyncio.run(MessageWriter(sio).flush(messages))
+    return sio.emitted
+
+
+def test_partial_bulk_write_reports_only_the_lost_messages(monkeypatch):
+    error = BulkWriteError({"nInserted": 0, "nUpserted": 1, "nMatched": 1, "writeErrors": [{"index": 2, "code": 1}]})
+    messages = batch(4)
+    emitted = flush(monkeypatch, {"messages": FakeCollection(error), "inbox": FakeCollection()}, messages)
+
+    events = {event: data for event, _, data in emitted}
+    assert [m["_id"] for m in events["message_ack"]] == [str(m[4]["_id"]) for m in messages[:2]]
+    assert [m["_id"] for m in events["error"]["messages"]] == [str(m[4]["_id"]) for m in messages[2:]]
+
+
+def test_unexpected_error_does_not_stop_the_writer(monkeypatch):
+    emitted = flush(monkeypatch, {"messages": FakeCollection(RuntimeError("boom"))}, batch(2))
+
+    assert [event for event, _, _ in emitted] == ["error"]
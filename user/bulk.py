@@ -0,0 +1,108 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator
+from pathlib import Path
+import asyncio
+import json
+
+from starlette.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+from pydantic import ValidationError
+
+from core.mongodb import Manager
+from core.settings import MONGODB_IMPORT_BATCH_SIZE, HASH_IMPORT_MAX_CONCURRENCY
+from .schemas import UserCreate
+from .utils import collection
+
+
+# Bounds the import's share of the hashing pool, so the logins are never queued behind a whole batch.
+hashing = asyncio.Semaphore(HASH_IMPORT_MAX_CONCURRENCY)
+
+
+class ImportResponse(StreamingResponse):
+    """
+    Streams results computed from the request body while it is still being received.
+
+    StreamingResponse listens for the disconnect by calling `receive` alongside the stream, which swallows
+    the body messages the stream is waiting for. Here the request stream is the only reader of `receive`,
+    and a disconnect surfaces from it as ClientDisconnect.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+
+async def ndjson_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[tuple]:
+    """
+    Splits a stream of bytes into numbered lines without buffering more than one line at a time.
+    """
+
+    buffer, number = b"", 0
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            number += 1
+            if line.strip():
+                yield number, line
+    if buffer.strip():
+        yield number + 1, buffer
+
+
+async def hash_password(user: UserCreate, pool: ThreadPoolExecutor = None) -> UserCreate:
+    if pool is not None:
+        return await user.hash_password(pool)
+    async with hashing:
+        return await user.hash_password()
+
+
+async def flush(batch: list, pool: ThreadPoolExecutor = None) -> list:
+    await asyncio.gather(*(hash_password(user, pool) for _, user in batch))
+    bodies = [user.model_dump() for _, user in batch]
+    errors = await Manager.create_many(collection, bodies)
+
+    res = []
+    for i, (number, _) in enumerate(batch):
+        if (error := errors.get(i)) is None:
+            res.append({"line": number, "status": "created", "object_id": str(bodies[i]["_id"])})
+        elif error["code"] == 11000:
+            res.append({"line": number, "status": "duplicate", "key": error.get("keyValue")})
+        else:
+            res.append({"line": number, "status": "failed", "message": error.get("errmsg")})
+    return res
+
+
+async def import_users(chunks: AsyncIterator[bytes], pool: ThreadPoolExecutor = None) -> AsyncIterator[dict]:
+    """
+    Imports the users of an NDJSON stream, one `UserCreate` object per line, and yields one result per line.
+    Passwords of a batch are hashed on all the threads of `pool` when given, otherwise on at most
+    HASH_IMPORT_MAX_CONCURRENCY threads of the shared hashing pool. Then the batch is written with one `insert_many`.
+    """
+
+    batch = []
+    async for number, line in ndjson_lines(chunks):
+        try:
+            batch.append((number, UserCreate.model_validate_json(line)))
+        except ValidationError as e:
+            yield {"line": number, "status": "invalid", "errors": json.loads(e.json(include_url=False))}
+            continue
+
+        if len(batch) >= MONGODB_IMPORT_BATCH_SIZE:
+            for res in await flush(batch, pool):
+                yield res
+            batch = []
+
+    for res in await flush(batch, pool):
+        yield res
+
+
+async def file_chunks(path: Path, size: int = 64 * 1024) -> AsyncIterator[bytes]:
+    with open(path, "rb") as file:
+        while chunk := file.read(size):
+            yield chunk
+
+
+async def ndjson(results: AsyncIterator[dict]) -> AsyncIterator[bytes]:
+    async for res in results:
+        yield (json.dumps(res) + "\n").encode()
@@ -0,0 +1,19 @@
+from typing import ClassVar
+
+from pymongo import ASCENDING
+
+from core.mongodb import Migration
+from core.settings import MONGODB_COLLECTION_USERS
+
+
+class User(Migration):
+    """
+    Indexes of the users collection. Kept apart from the schemas, so `migrate` does not import FastAPI.
+    """
+
+    collection: ClassVar = MONGODB_COLLECTION_USERS
+    unique: ClassVar = [("username", ASCENDING), ("email", ASCENDING)]
+    indexes: ClassVar = [
+        [("username", ASCENDING), ("_id", ASCENDING)],
+        [("email", ASCENDING), ("_id", ASCENDING)]
+    ]
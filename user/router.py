@@ -1,10 +1,12 @@
-from fastapi import APIRouter, status
+from fastapi import APIRouter, Request, status
 import bson
 
 from core.mongodb import Manager
 from auth.utils import ensure_authority
+from auth.cache import invalidate_user
 from .schemas import UserResponse, UsersResponse
 from .utils import collection, ObjectID, User, UserCreate, UserUpdate, ReadUsersQP
+from . import bulk
 
 
 router = APIRouter()
@@ -20,7 +22,8 @@ router = APIRouter()
 )
 @ensure_authority(mode="admin")
 async def read_users(user: User, qp: ReadUsersQP):
-    return UsersResponse(users=await Manager.get_all_or_fail(collection, qp))
+    users = await Manager.get_all_or_fail(collection, qp)
+    return UsersResponse(users=users, **qp.cursors(users))
 
 
 @router.get(
@@ -46,11 +49,30 @@ async def read_user(user: User, object_id: ObjectID):
     status_code=status.HTTP_201_CREATED
 )
 async def create_user(body: UserCreate):
+    body = await body.hash_password()
     new_user = await Manager.create_or_fail(collection, body.model_dump())
     created_user = await Manager.get_or_fail(collection, {"_id": bson.ObjectId(new_user.inserted_id)})
     return created_user
 
 
+@router.post(
+    "/import/",
+    response_class=bulk.ImportResponse,
+    response_description="Operation successful.",
+    description=(
+        "Imports the users of an NDJSON request body, one user object per line, "
+        "and streams back one NDJSON result per line: created, duplicate, invalid or failed."
+    ),
+    summary="Import Users"
+)
+@ensure_authority(mode="admin")
+async def import_users(user: User, request: Request):
+    return bulk.ImportResponse(
+        bulk.ndjson(bulk.import_users(request.stream())),
+        media_type="application/x-ndjson"
+    )
+
+
 @router.put(
     "/{object_id}/",
     response_model=UserResponse,
@@ -61,11 +83,13 @@ async def create_user(body: UserCreate):
 )
 @ensure_authority("normal")
 async def update_user(user: User, object_id: ObjectID, body: UserUpdate):
-    body = body.absolute_model_dump()
+    body = (await body.hash_password()).absolute_model_dump()
     if len(body) < 1:
         return await Manager.get_or_fail(collection, {"_id": bson.ObjectId(object_id)})
     else:
-        return await Manager.update_or_fail(collection, object_id, "$set", body)
+        updated_user = await Manager.update_or_fail(collection, object_id, "$set", body)
+        await invalidate_user(user["username"], updated_user["username"])
+        return updated_user
 
 
 @router.delete(
@@ -78,3 +102,4 @@ async def update_user(user: User, object_id: ObjectID, body: UserUpdate):
 @ensure_authority("normal")
 async def delete_user(user: User, object_id: ObjectID):
     await Manager.delete_or_fail(collection, object_id)
+    await invalidate_user(user["username"])
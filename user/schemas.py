@@ -1,12 +1,13 @@
-from typing import Annotated, Optional, Literal, List, ClassVar
+from concurrent.futures import ThreadPoolExecutor
+from typing import Annotated, Optional, Literal, List
 from abc import ABC
 
 from fastapi import Query
 from pymongo import ASCENDING, DESCENDING
-from pydantic import BaseModel, ConfigDict, Field, EmailStr, SecretStr, BeforeValidator, field_validator, model_validator
+from pydantic import BaseModel, ConfigDict, Field, EmailStr, SecretStr, BeforeValidator, field_validator
 
-from core.hash import hash_password as hp
-from core.mongodb import Migration
+from core.hash import hash_password_async as hp
+from core.mongodb import page_cursors
 
 
 username_field = {
@@ -20,10 +21,7 @@ password_field = {
 }
 
 
-class BaseUser(BaseModel, Migration, ABC):
-    collection: ClassVar = "users"
-    unique: ClassVar = [("username", ASCENDING), ("email", ASCENDING)]
-
+class BaseUser(BaseModel, ABC):
     model_config = ConfigDict(extra="forbid")
 
     @field_validator('*', mode='after')
@@ -32,11 +30,15 @@ class BaseUser(BaseModel, Migration, ABC):
             raise ValueError('Fields must not contain spaces.')
         return value
 
-    @model_validator(mode='after')
-    def hash_password(cls, items):
-        if items.password is not None:
-            items.password = hp(items.password.get_secret_value())
-        return items
+    async def hash_password(self, pool: ThreadPoolExecutor = None):
+        """
+        Hashes the password off the event loop, on `pool` or the shared hashing pool.
+        Call this before dumping the model into the database.
+        """
+
+        if self.password is not None:
+            self.password = await hp(self.password.get_secret_value(), pool)
+        return self
 
 
 class UserCreate(BaseUser):
@@ -63,6 +65,8 @@ class UserResponse(BaseModel):
 
 class UsersResponse(BaseModel):
     users: List[UserResponse]
+    before: Optional[str] = None
+    after: Optional[str] = None
 
 
 class ReadUsersQP(BaseModel):
@@ -78,6 +82,12 @@ class ReadUsersQP(BaseModel):
     limit: Optional[int] = Query(
         10, ge=1, le=100, description="Number of users to return"
     )
+    after: Optional[str] = Query(
+        None, description="The `after` cursor of a page; returns the users following that page"
+    )
+    before: Optional[str] = Query(
+        None, description="The `before` cursor of a page; returns the users preceding that page"
+    )
 
     @field_validator('order_direction', mode='after')
     def convert_order_direction(cls, value):
@@ -86,3 +96,6 @@ class ReadUsersQP(BaseModel):
     @field_validator('order_by', mode='after')
     def convert_order_by(cls, value):
         return "_id" if value == "object_id" else value
+
+    def cursors(self, users: list) -> dict:
+        return page_cursors(users, self.order_by, self.order_direction)